@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Benchmark the phases of a reconciliation with many synthetic home directories.
+
+Three modes are supported:
+
+- `xfs` creates the home directories on a real XFS filesystem mounted with pquota
+  (like the one set up by mount-xfs.sh), and runs xfs_quota for real. The first pass
+  sets up every project, the second one finds nothing to do. With `--record`, the
+  resulting `xfs_quota report` output and project IDs are saved for replaying.
+- `replay` works on any filesystem. Project IDs and `xfs_quota report` output are
+  either replayed from a recording, or synthesized with every home already set up and
+  `--dirty` of them needing their limits applied again. Every xfs_quota call is
+  replaced by a subprocess that prints the recorded output, so process spawning and
+  parsing costs are still measured.
+- `fake` keeps project IDs and quotas in memory with FakeQuotaBackend, optionally with
+  `--latency` per operation, to profile the QuotaManager itself on any filesystem.
+
+For every number of homes, the wall time, number of subprocesses run and peak RSS of
+each phase are reported.
+
+Examples:
+
+    python dev-scripts/benchmark.py replay --homes 1000 10000 50000
+    python dev-scripts/benchmark.py xfs --base /mnt/docker-test-xfs/bench --homes 1000
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from traitlets import Dict, Unicode
+
+# Import jupyterhub_home_nfs from this checkout, even when it isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jupyterhub_home_nfs import metrics
+from jupyterhub_home_nfs.backends import FakeQuotaBackend, XfsQuotaBackend
+from jupyterhub_home_nfs.generate import QuotaManager
+
+REPORT_COMMAND = "report -N -p -bir"
+GIB_TO_KIB = 1024 * 1024
+
+
+class ReplayBackend(XfsQuotaBackend):
+    """
+    xfs_quota backend replaying recorded project IDs and report output
+    """
+
+    report_file = Unicode(help="File with the output of xfs_quota report to replay")
+
+    projids = Dict(help="Mapping of home directory paths to their project ID on disk")
+
+    def read_project(self, path):
+        # Open the directory like the real ioctl does, so its cost is still counted
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        os.close(fd)
+        projid = self.projids.get(path)
+        return (projid, True) if projid else (0, False)
+
+    def xfs_quota_args(self, commands, mountpoints, kwargs):
+        super().xfs_quota_args(commands, mountpoints, kwargs)
+        if commands[0] == REPORT_COMMAND:
+            return ["cat", self.report_file]
+        return ["true"]
+
+
+def subprocess_calls():
+    """
+    Return the number of subprocesses run so far
+    """
+    return sum(
+        sample.value
+        for metric in metrics.SUBPROCESS_CALLS.collect()
+        for sample in metric.samples
+        if sample.name.endswith("_total")
+    )
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process, returning False if that isn't supported
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_kib():
+    """
+    Return the peak RSS of this process in KiB, since it was last reset if possible
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(results, phase, func, *args):
+    """
+    Run func, recording its wall time, subprocess count & peak RSS in results
+    """
+    reset_peak_rss()
+    calls = subprocess_calls()
+    start = time.perf_counter()
+    value = func(*args)
+    results.append(
+        {
+            "phase": phase,
+            "seconds": time.perf_counter() - start,
+            "subprocesses": int(subprocess_calls() - calls),
+            "peak_rss_kib": peak_rss_kib(),
+        }
+    )
+    return value
+
+
+def synthesize_recording(base, count, *, min_projid, hard_quota, dirty):
+    """
+    Return project IDs and report output for `count` homes that are all set up already.
+
+    Every 1 / dirty-th home is reported without limits, so it needs them applied again.
+    """
+    projids = {}
+    lines = []
+    dirty_every = round(1 / dirty) if dirty else 0
+    for i in range(count):
+        path = os.path.join(base, f"home-{i}")
+        projid = min_projid + 1 + i
+        projids[path] = projid
+        limit = 0 if dirty_every and i % dirty_every == 0 else hard_quota
+        lines.append(
+            f"{path} {i % 4096} 0 {limit} 00 [--------] "
+            f"{i % 100 + 1} 0 0 00 [--------] 0 0 0 00 [--------]"
+        )
+    return projids, "\n".join(lines) + "\n"
+
+
+def load_recording(recording_dir, base):
+    """
+    Return project IDs and report output recorded with --record, moved to base
+    """
+    with open(os.path.join(recording_dir, "projects.json")) as f:
+        recording = json.load(f)
+    with open(os.path.join(recording_dir, "report.txt")) as f:
+        report = f.read()
+    recorded_base = recording["base"].rstrip("/") + "/"
+    projids = {
+        os.path.join(base, name): projid
+        for name, projid in recording["projects"].items()
+    }
+    return projids, report.replace(recorded_base, base.rstrip("/") + "/")
+
+
+def save_recording(quota_manager, recording_dir, base):
+    """
+    Save project IDs and xfs_quota report output, for replaying later
+    """
+    os.makedirs(recording_dir, exist_ok=True)
+    mountpoint = quota_manager.mountpoint_for(os.path.join(base, "home-0"))
+    report = quota_manager.quota_backend.xfs_quota(
+        [REPORT_COMMAND], [mountpoint], log_stdout=False
+    )
+    with open(os.path.join(recording_dir, "report.txt"), "w") as f:
+        f.write(report)
+    projects = {
+        os.path.basename(path): projid
+        for path, projid in quota_manager.get_applied_projects().items()
+    }
+    with open(os.path.join(recording_dir, "projects.json"), "w") as f:
+        json.dump({"base": base, "projects": projects}, f)
+
+
+def run(args, count, workdir):
+    """
+    Benchmark the phases of reconciling `count` homes, returning their results
+    """
+    base = os.path.join(args.base or workdir, f"homes-{count}")
+    os.makedirs(base)
+    for i in range(count):
+        os.mkdir(os.path.join(base, f"home-{i}"))
+
+    QuotaManager.clear_instance()
+    quota_manager = QuotaManager.instance(
+        paths=[base],
+        projid_file=os.path.join(workdir, f"projid-{count}"),
+        projects_file=os.path.join(workdir, f"projects-{count}"),
+        min_projid=args.min_projid,
+        hard_quota=args.hard_quota,
+        log_level=logging.WARNING,
+    )
+
+    if args.mode == "fake":
+        quota_manager.quota_backend_class = FakeQuotaBackend
+        quota_manager.quota_backend.latency = args.latency
+    elif args.mode == "replay":
+        recording_dir = args.replay and os.path.join(args.replay, str(count))
+        if recording_dir:
+            projids, report = load_recording(recording_dir, base)
+        else:
+            projids, report = synthesize_recording(
+                base,
+                count,
+                min_projid=args.min_projid,
+                hard_quota=int(args.hard_quota * GIB_TO_KIB),
+                dirty=args.dirty,
+            )
+        report_file = os.path.join(workdir, f"report-{count}.txt")
+        with open(report_file, "w") as f:
+            f.write(report)
+        quota_manager.quota_backend = ReplayBackend(
+            parent=quota_manager,
+            projects_file=quota_manager.projects_file,
+            projid_file=quota_manager.projid_file,
+            report_file=report_file,
+            projids=projids,
+        )
+        # Home directories already have their project IDs in the projid files
+        quota_manager.write_projfiles(projids)
+
+    results = []
+    measure(results, "reconcile_projfiles", quota_manager.reconcile_projfiles)
+    measure(results, "get_applied_projects", quota_manager.get_applied_projects)
+    measure(results, "get_applied_quotas", quota_manager.get_applied_quotas)
+    measure(results, "reconcile_quotas", quota_manager.reconcile_quotas)
+    measure(results, "reconcile_step (again)", quota_manager.reconcile_step)
+
+    if args.record:
+        save_recording(quota_manager, os.path.join(args.record, str(count)), base)
+    if args.base:
+        shutil.rmtree(base)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("mode", choices=["xfs", "replay", "fake"])
+    parser.add_argument(
+        "--homes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Numbers of home directories to benchmark with",
+    )
+    parser.add_argument(
+        "--base",
+        help=(
+            "Directory to create home directories in. Required with xfs, where it must "
+            "be on an XFS filesystem mounted with pquota. Defaults to a temporary "
+            "directory otherwise"
+        ),
+    )
+    parser.add_argument(
+        "--replay",
+        help="Directory with recordings made with --record, instead of synthetic ones",
+    )
+    parser.add_argument(
+        "--record", help="Directory to save recordings to, for replaying later"
+    )
+    parser.add_argument(
+        "--dirty",
+        type=float,
+        default=0.01,
+        help="Fraction of synthetic homes that need their limits applied again",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Number of seconds each operation of the fake backend takes",
+    )
+    parser.add_argument("--hard-quota", type=float, default=1)
+    parser.add_argument("--min-projid", type=int, default=1000)
+    parser.add_argument("--json", help="File to write the results to, as JSON")
+    args = parser.parse_args()
+
+    if args.mode == "xfs" and not args.base:
+        parser.error("--base is required with xfs")
+    if not reset_peak_rss():
+        print(
+            "Resetting peak RSS is not supported, so it is the peak since start",
+            file=sys.stderr,
+        )
+
+    all_results = {}
+    print(f"{'homes':>7} {'phase':<28} {'seconds':>9} {'subprocs':>9} {'peak RSS':>10}")
+    for count in args.homes:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = all_results[count] = run(args, count, workdir)
+        for result in results:
+            print(
+                f"{count:>7} {result['phase']:<28} {result['seconds']:>9.3f} "
+                f"{result['subprocesses']:>9} {result['peak_rss_kib'] // 1024:>7} MiB"
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"mode": args.mode, "results": all_results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
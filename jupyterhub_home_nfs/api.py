@@ -0,0 +1,153 @@
+"""
+Small HTTP API to act on a single home directory, without waiting for the next run.
+
+Every request must carry the configured token, as `Authorization: token <token>` (as
+JupyterHub does) or `Authorization: Bearer <token>`. Home directories are referred to by
+name, as in `quota_overrides`. Available endpoints:
+
+- `GET /api/homes/<name>`: usage & limits of the home directory, as last read
+- `POST /api/homes/<name>/reconcile`: set up the home directory and apply its limits now
+- `PUT /api/homes/<name>/override`: set a temporary override of its limits, from a JSON
+  body with any of the keys of `quota_overrides` entries, and optionally `expires_in`
+  (in seconds)
+- `DELETE /api/homes/<name>/override`: remove the temporary override
+"""
+
+import hmac
+import json
+import re
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+ROUTE = re.compile(r"/api/homes/(?P<name>[^/]+)(?P<action>/reconcile|/override)?/?")
+
+
+class APIError(Exception):
+    """
+    Error to report to the client, with an HTTP status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests to the API of `self.server.quota_manager`
+    """
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PUT(self):
+        self.handle_api("PUT")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def handle_api(self, method):
+        try:
+            self.check_token()
+            match = ROUTE.fullmatch(self.path.split("?", 1)[0])
+            if match is None:
+                raise APIError(HTTPStatus.NOT_FOUND, "Not found")
+            name = unquote(match["name"])
+            handler = {
+                ("GET", None): self.get_home,
+                ("POST", "/reconcile"): self.reconcile_home,
+                ("PUT", "/override"): self.set_override,
+                ("DELETE", "/override"): self.clear_override,
+            }.get((method, match["action"]))
+            if handler is None:
+                raise APIError(HTTPStatus.METHOD_NOT_ALLOWED, "Method not allowed")
+            self.send_json(HTTPStatus.OK, handler(name))
+        except APIError as e:
+            self.send_json(e.status, {"error": e.message})
+        except Exception as e:
+            self.server.quota_manager.log.error(
+                f"API request {method} {self.path} failed! Continuing...", exc_info=e
+            )
+            self.send_json(
+                HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Internal error"}
+            )
+
+    def check_token(self):
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() not in ("token", "bearer") or not hmac.compare_digest(
+            token.strip().encode(), self.server.token.encode()
+        ):
+            raise APIError(HTTPStatus.UNAUTHORIZED, "Missing or invalid token")
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise APIError(HTTPStatus.BAD_REQUEST, "Request body must be JSON")
+        if not isinstance(body, dict):
+            raise APIError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object")
+        return body
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def home_status(self, name):
+        status = self.server.quota_manager.home_status(name)
+        if status is None:
+            raise APIError(HTTPStatus.NOT_FOUND, f"No home directory {name!r}")
+        return status
+
+    def get_home(self, name):
+        return self.home_status(name)
+
+    def reconcile_home(self, name):
+        if not self.server.quota_manager.reconcile_home(name):
+            raise APIError(HTTPStatus.NOT_FOUND, f"No home directory {name!r}")
+        return self.home_status(name)
+
+    def set_override(self, name):
+        body = self.read_json()
+        expires_in = body.pop("expires_in", None)
+        try:
+            found = self.server.quota_manager.set_temporary_override(
+                name, body, expires_in=expires_in
+            )
+        except ValueError as e:
+            raise APIError(HTTPStatus.BAD_REQUEST, str(e))
+        if not found:
+            raise APIError(HTTPStatus.NOT_FOUND, f"No home directory {name!r}")
+        return self.home_status(name)
+
+    def clear_override(self, name):
+        self.server.quota_manager.clear_temporary_override(name)
+        return self.home_status(name)
+
+    def log_message(self, format, *args):
+        self.server.quota_manager.log.debug(f"API: {format % args}")
+
+
+def start_api_server(quota_manager, ip, port, token):
+    """
+    Serve the API for quota_manager on ip & port in a daemon thread.
+
+    Returns the server and the thread, like prometheus_client's start_http_server.
+    """
+    server = ThreadingHTTPServer((ip, port), APIRequestHandler)
+    server.daemon_threads = True
+    server.quota_manager = quota_manager
+    server.token = token
+    thread = threading.Thread(target=server.serve_forever, name="api", daemon=True)
+    thread.start()
+    return server, thread
@@ -0,0 +1,987 @@
+"""
+Ways of reading and applying XFS project quotas.
+
+The QuotaManager decides which home directories should have which quotas, and a
+QuotaBackend knows how to read and apply them on the filesystem. Which backend is used
+is configured with `QuotaManager.quota_backend_class`.
+"""
+
+import asyncio
+import ctypes
+import errno
+import logging
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+from traitlets import Bool, CaselessStrEnum, Float, Int, Set, Unicode
+from traitlets.config import LoggingConfigurable
+
+from . import metrics
+from .fsxattr import get_project
+from .quotas import QuotaRecord, QuotaTable
+
+# A bracketed group, like the "[6 days]" grace time in xfs_quota reports, or a word
+REPORT_TOKEN = re.compile(r"\[[^\]]*\]|\S+")
+
+# Only the end of stderr is logged, so verbose commands can't use up all our memory
+MAX_LOGGED_STDERR_LINES = 100
+MAX_LOGGED_LINE_LENGTH = 4096
+
+
+class OutputTail:
+    """
+    Keep the last lines of a stream of output, counting the ones dropped
+    """
+
+    def __init__(self, max_lines=MAX_LOGGED_STDERR_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def add(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line.rstrip("\n"))
+
+    def log(self, logger, level):
+        if self.dropped:
+            logger.log(level, f"({self.dropped} earlier lines of stderr not logged)")
+        for line in self.lines:
+            logger.log(level, line)
+
+    def drain(self, stream):
+        """
+        Read stream until it is closed, cutting overly long lines short
+        """
+        with stream:
+            while line := stream.readline(MAX_LOGGED_LINE_LENGTH):
+                if not line.endswith("\n"):
+                    # Skip the rest of the line
+                    while (rest := stream.readline(MAX_LOGGED_LINE_LENGTH)) and (
+                        not rest.endswith("\n")
+                    ):
+                        pass
+                self.add(line)
+
+    async def async_drain(self, stream):
+        """
+        Like drain, for an asyncio StreamReader
+        """
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Longer than the stream's limit, and skipped by it
+                self.add("[line too long]")
+                continue
+            if not line:
+                break
+            self.add(line[:MAX_LOGGED_LINE_LENGTH].decode("utf8", "surrogateescape"))
+
+
+def check_finished(args, logger, command, returncode, stderr, timeout, timed_out):
+    """
+    Log the stderr of a finished process, and raise if it failed or timed out
+    """
+    if timed_out:
+        metrics.SUBPROCESS_FAILURES.labels(command=command).inc()
+        logger.error(f"{command} timed out after {timeout}s, killed it")
+        if stderr is not None:
+            stderr.log(logger, logging.ERROR)
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    # Set log level according to return code
+    log_level = logging.ERROR if returncode else logging.DEBUG
+    if stderr is not None:
+        stderr.log(logger, log_level)
+    if returncode:
+        metrics.SUBPROCESS_FAILURES.labels(command=command).inc()
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def iter_check_call(args, logger, *, command=None, log_stderr=True, timeout=None):
+    """
+    Run a process, yielding the lines of its stdout as they are produced.
+
+    Only the last lines of stderr are kept and logged, so memory use stays the same
+    however much output the process produces. Once all of stdout is consumed,
+    `subprocess.CalledProcessError` is raised if the process failed. With a `timeout`
+    (in seconds), the process is killed and `subprocess.TimeoutExpired` raised if it
+    runs for longer. The process is killed too if iteration stops early.
+
+    `command` labels the call in metrics, and defaults to the name of the program.
+    """
+    if command is None:
+        command = os.path.basename(args[0])
+    metrics.SUBPROCESS_CALLS.labels(command=command).inc()
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        # Only record stderr if asked
+        stderr=subprocess.PIPE if log_stderr else subprocess.DEVNULL,
+        encoding="utf8",
+        errors="surrogateescape",
+    )
+
+    stderr = None
+    if log_stderr:
+        # Read stderr alongside stdout, so neither pipe can fill up and block
+        stderr = OutputTail()
+        stderr_thread = threading.Thread(
+            target=stderr.drain, args=(process.stderr,), daemon=True
+        )
+        stderr_thread.start()
+
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    try:
+        with process.stdout:
+            yield from process.stdout
+        process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if log_stderr:
+            stderr_thread.join()
+
+    check_finished(
+        args, logger, command, process.returncode, stderr, timeout, timed_out.is_set()
+    )
+
+
+async def async_iter_check_call(
+    args, logger, *, command=None, log_stderr=True, timeout=None
+):
+    """
+    Like `iter_check_call`, without blocking the event loop.
+
+    The process is killed if the calling task is cancelled. Close the iterator with
+    `aclose()` when not consuming all of it.
+    """
+    if command is None:
+        command = os.path.basename(args[0])
+    metrics.SUBPROCESS_CALLS.labels(command=command).inc()
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if log_stderr else subprocess.DEVNULL,
+    )
+
+    stderr = None
+    if log_stderr:
+        stderr = OutputTail()
+        stderr_task = asyncio.ensure_future(stderr.async_drain(process.stderr))
+
+    timed_out = False
+    timer = None
+    if timeout:
+
+        def kill():
+            nonlocal timed_out
+            timed_out = True
+            process.kill()
+
+        timer = asyncio.get_running_loop().call_later(timeout, kill)
+
+    try:
+        async for line in process.stdout:
+            yield line.decode("utf8", "surrogateescape")
+        await process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        # Don't leave the process behind on errors or cancellation
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if log_stderr:
+            await stderr_task
+
+    check_finished(
+        args, logger, command, process.returncode, stderr, timeout, timed_out
+    )
+
+
+def log_stdout_lines(logger, lines, failed):
+    # Set log level according to whether the process failed
+    log_level = logging.ERROR if failed else logging.DEBUG
+    for line in lines:
+        logger.log(log_level, line.rstrip("\n"))
+
+
+def logged_check_call(
+    args,
+    logger,
+    *,
+    command=None,
+    log_stdout=True,
+    log_stderr=True,
+    timeout=None,
+):
+    """
+    Run `subprocess.check_call` with a logger to output stdio.
+    Return the stdout of the stream.
+
+    Meant for commands with little output, see `iter_check_call` for the others.
+    """
+    lines = []
+    try:
+        for line in iter_check_call(
+            args, logger, command=command, log_stderr=log_stderr, timeout=timeout
+        ):
+            lines.append(line)
+    except subprocess.SubprocessError:
+        if log_stdout:
+            log_stdout_lines(logger, lines, True)
+        raise
+    if log_stdout:
+        log_stdout_lines(logger, lines, False)
+    return "".join(lines)
+
+
+async def async_logged_check_call(
+    args,
+    logger,
+    *,
+    command=None,
+    log_stdout=True,
+    log_stderr=True,
+    timeout=None,
+):
+    """
+    Like `logged_check_call`, without blocking the event loop
+    """
+    lines = []
+    try:
+        async for line in async_iter_check_call(
+            args, logger, command=command, log_stderr=log_stderr, timeout=timeout
+        ):
+            lines.append(line)
+    except subprocess.SubprocessError:
+        if log_stdout:
+            log_stdout_lines(logger, lines, True)
+        raise
+    if log_stdout:
+        log_stdout_lines(logger, lines, False)
+    return "".join(lines)
+
+
+class QuotaBackend(LoggingConfigurable):
+    """
+    Base class for reading and applying project quotas.
+
+    Quotas are returned as a QuotaTable, keyed by project path.
+    """
+
+    projects_file = Unicode(help="Path to projects file, set by the QuotaManager")
+
+    projid_file = Unicode(help="Path to projid file, set by the QuotaManager")
+
+    command_timeout = Float(
+        default_value=0,
+        help=(
+            "Number of seconds after which a command reading or setting quotas is "
+            "killed and counted as failed, 0 for no limit"
+        ),
+    ).tag(config=True)
+
+    setup_timeout = Float(
+        default_value=0,
+        help=(
+            "Number of seconds after which a project setup, which walks the whole home "
+            "directory, is killed and counted as failed, 0 for no limit. Killed setups "
+            "are run again in the next run"
+        ),
+    ).tag(config=True)
+
+    setup_nice = Int(
+        default_value=0,
+        help=(
+            "CPU niceness (see nice(1)) to run project setups with, so walking large "
+            "home directories competes less with serving them over NFS"
+        ),
+    ).tag(config=True)
+
+    setup_ionice_class = CaselessStrEnum(
+        ["", "idle", "best-effort"],
+        default_value="",
+        help=(
+            "I/O scheduling class (see ionice(1)) to run project setups with. "
+            "Empty to leave it as is"
+        ),
+    ).tag(config=True)
+
+    setup_ionice_level = Int(
+        default_value=7,
+        min=0,
+        max=7,
+        help="I/O priority within the best-effort class, from 0 (highest) to 7 (lowest)",
+    ).tag(config=True)
+
+    def setup_command_prefix(self):
+        """
+        Return the command to prefix project setup commands with, applying setup_nice
+        and setup_ionice_class
+        """
+        prefix = []
+        if self.setup_ionice_class == "idle":
+            prefix.extend(["ionice", "-c", "idle"])
+        elif self.setup_ionice_class == "best-effort":
+            prefix.extend(
+                ["ionice", "-c", "best-effort", "-n", str(self.setup_ionice_level)]
+            )
+        if self.setup_nice:
+            prefix.extend(["nice", "-n", str(self.setup_nice)])
+        return prefix
+
+    def read_project(self, path):
+        """
+        Return a tuple of (project ID, inherit flag) for the directory at path
+        """
+        raise NotImplementedError()
+
+    def setup_project(self, mountpoint, project):
+        """
+        Tag every file in the project at path `project` with its project ID.
+
+        Raises an exception if this failed.
+        """
+        raise NotImplementedError()
+
+    def get_applied_quotas(self, mountpoints, projects):
+        """
+        Return the quotas currently applied on the given mountpoints.
+
+        `projects` is a mapping of project paths to project IDs.
+        """
+        raise NotImplementedError()
+
+    def set_grace_period(self, mountpoint, seconds):
+        """
+        Set how long projects on mountpoint may stay over their soft block limit.
+
+        XFS only keeps one grace period per filesystem for project quotas, so this
+        applies to all projects on it.
+        """
+        raise NotImplementedError()
+
+    def set_limits(self, mountpoint, limits):
+        """
+        Set hard quotas for projects on a mountpoint, clearing all other limits.
+
+        `limits` is a list of (project path, project ID, QuotaRecord) tuples, with the
+        block and inode limits to set. Block limits are in KiB.
+        Failures are logged per project, and the list of projects that limits were
+        successfully set for is returned.
+        """
+        raise NotImplementedError()
+
+    # Coroutine versions of the operations, used by QuotaManager.use_asyncio. These
+    # run the blocking versions in a thread, which can't be interrupted when cancelled.
+
+    async def async_setup_project(self, mountpoint, project):
+        await asyncio.to_thread(self.setup_project, mountpoint, project)
+
+    async def async_get_applied_quotas(self, mountpoints, projects):
+        return await asyncio.to_thread(self.get_applied_quotas, mountpoints, projects)
+
+    async def async_set_limits(self, mountpoint, limits):
+        return await asyncio.to_thread(self.set_limits, mountpoint, limits)
+
+
+class XfsQuotaBackend(QuotaBackend):
+    """
+    Read and apply quotas by running the xfs_quota command line tool.
+    """
+
+    def read_project(self, path):
+        return get_project(path)
+
+    def xfs_quota_args(self, commands, mountpoints, kwargs):
+        """
+        Return the arguments to run xfs_quota in expert mode with the given commands,
+        using our project files, and fill in the defaults of kwargs for running it
+        """
+        # Commands to run xfs_quota with, like nice
+        args = [*kwargs.pop("prefix", ()), "xfs_quota", "-x"]
+        for command in commands:
+            args.extend(["-c", command])
+        args.extend(["-D", self.projects_file, "-P", self.projid_file, *mountpoints])
+        # Label calls with the xfs_quota command they run, e.g. "xfs_quota report"
+        kwargs.setdefault("command", f"xfs_quota {commands[0].split()[0]}")
+        kwargs.setdefault("timeout", self.command_timeout or None)
+        return args
+
+    def xfs_quota(self, commands, mountpoints, **kwargs):
+        """
+        Run xfs_quota in expert mode with the given commands, using our project files
+        """
+        args = self.xfs_quota_args(commands, mountpoints, kwargs)
+        return logged_check_call(args, self.log, **kwargs)
+
+    def xfs_quota_lines(self, commands, mountpoints, **kwargs):
+        """
+        Like xfs_quota, yielding lines of output as they are produced
+        """
+        args = self.xfs_quota_args(commands, mountpoints, kwargs)
+        return iter_check_call(args, self.log, **kwargs)
+
+    async def async_xfs_quota(self, commands, mountpoints, **kwargs):
+        """
+        Like xfs_quota, without blocking the event loop
+        """
+        args = self.xfs_quota_args(commands, mountpoints, kwargs)
+        return await async_logged_check_call(args, self.log, **kwargs)
+
+    def async_xfs_quota_lines(self, commands, mountpoints, **kwargs):
+        """
+        Like xfs_quota_lines, without blocking the event loop
+        """
+        args = self.xfs_quota_args(commands, mountpoints, kwargs)
+        return async_iter_check_call(args, self.log, **kwargs)
+
+    def setup_project(self, mountpoint, project):
+        self.xfs_quota(
+            [f"project -s {project}"],
+            [mountpoint],
+            # stderr can be huge for this call, because it includes verbose per-file information
+            # let's exclude it to avoid OOM errors with large amounts of string processing'
+            log_stderr=False,
+            timeout=self.setup_timeout or None,
+            prefix=self.setup_command_prefix(),
+        )
+
+    async def async_setup_project(self, mountpoint, project):
+        await self.async_xfs_quota(
+            [f"project -s {project}"],
+            [mountpoint],
+            log_stderr=False,
+            timeout=self.setup_timeout or None,
+            prefix=self.setup_command_prefix(),
+        )
+
+    def get_applied_quotas(self, mountpoints, projects):
+        # Parsed as it is produced, so the whole report is never held in memory
+        return self.parse_report(
+            self.xfs_quota_lines(["report -N -p -bir"], mountpoints)
+        )
+
+    async def async_get_applied_quotas(self, mountpoints, projects):
+        quotas = QuotaTable()
+        lines = self.async_xfs_quota_lines(["report -N -p -bir"], mountpoints)
+        try:
+            async for line in lines:
+                self.parse_report_line(quotas, line)
+        finally:
+            await lines.aclose()
+        return quotas
+
+    def parse_report(self, report):
+        """
+        Parse the output of `xfs_quota -c "report -N -p -bir"` into a QuotaTable
+
+        `report` is either the whole output, or an iterable of its lines.
+        """
+        if isinstance(report, str):
+            report = report.splitlines()
+        quotas = QuotaTable()
+        for line in report:
+            self.parse_report_line(quotas, line)
+        return quotas
+
+    def parse_report_line(self, quotas, line):
+        """
+        Parse a line of the output of `xfs_quota -c "report -N -p -bir"` into quotas
+        """
+        # Grace times of projects over their soft limit contain spaces, e.g.
+        # "[6 days]", so keep anything in brackets together
+        parts = REPORT_TOKEN.findall(line)
+        if not parts:
+            return
+        # There are always 15 items at the end of the xfs_quota command output:
+        # 5 items (used, soft, hard, warn, grace) for each of Blocks, Inodes and Realtime
+        items = parts[-15:]
+        # The path (Project Id) is what's left to the left of these items
+        path = "".join(parts[:-15])
+        # Everything here is in kb, since that's what xfs_quota reports things in
+        quotas.set(
+            path,
+            QuotaRecord._make(int(items[i + j]) for i in (0, 5, 10) for j in range(3)),
+        )
+
+    def set_grace_period(self, mountpoint, seconds):
+        self.xfs_quota([f"timer -p -b {seconds}"], [mountpoint])
+
+    def limit_commands(self, limits):
+        """
+        Return the xfs_quota commands to set limits, see set_limits
+        """
+        return [
+            f"limit -p bhard={intended.blocks_hard}k bsoft={intended.blocks_soft}k "
+            f"ihard={intended.inodes_hard} isoft={intended.inodes_soft} "
+            f"rtbsoft=0 rtbhard=0 {project}"
+            for project, _, intended in limits
+        ]
+
+    def limits_failed(self, limits, error):
+        """
+        Handle a failed call setting limits, returning True if it should be retried in
+        smaller batches
+        """
+        if isinstance(error, subprocess.TimeoutExpired):
+            # Smaller batches would most likely hang just the same
+            self.log.error(
+                f"Setting limits for a batch of {len(limits)} projects timed out! Continuing...",
+                exc_info=error,
+            )
+            return False
+        if len(limits) == 1:
+            project, _, _ = limits[0]
+            self.log.error(
+                f"Setting up limit for {project} failed! Continuing...",
+                exc_info=error,
+            )
+            return False
+        self.log.warning(
+            f"Setting limits for a batch of {len(limits)} projects failed, retrying in smaller batches"
+        )
+        return True
+
+    def set_limits(self, mountpoint, limits):
+        """
+        Set limits for all projects in a single xfs_quota call.
+
+        If the call fails, the batch is split in half and each half retried, so that we
+        can tell exactly which projects failed. Setting a limit is idempotent, so
+        re-running the commands that did succeed is harmless.
+        """
+        try:
+            self.xfs_quota(self.limit_commands(limits), [mountpoint])
+        except subprocess.SubprocessError as e:
+            if not self.limits_failed(limits, e):
+                return []
+        else:
+            return [project for project, _, _ in limits]
+
+        middle = len(limits) // 2
+        return self.set_limits(mountpoint, limits[:middle]) + self.set_limits(
+            mountpoint, limits[middle:]
+        )
+
+    async def async_set_limits(self, mountpoint, limits):
+        try:
+            await self.async_xfs_quota(self.limit_commands(limits), [mountpoint])
+        except subprocess.SubprocessError as e:
+            if not self.limits_failed(limits, e):
+                return []
+        else:
+            return [project for project, _, _ in limits]
+
+        middle = len(limits) // 2
+        return await self.async_set_limits(
+            mountpoint, limits[:middle]
+        ) + await self.async_set_limits(mountpoint, limits[middle:])
+
+
+# quotactl commands & flags, from <linux/quota.h> and <linux/dqblk_xfs.h>
+PRJQUOTA = 2
+Q_XSETQLIM = 0x5804
+Q_XGETNEXTQUOTA = 0x5809
+FS_DQUOT_VERSION = 1
+FS_PROJ_QUOTA = 2
+# Soft & hard limits for inodes, blocks and realtime blocks
+FS_DQ_LIMIT_MASK = 0x3F
+FS_DQ_BTIMER = 0x40
+# Quotas are counted in 512 byte "basic blocks"
+BASIC_BLOCKS_PER_KIB = 2
+
+
+def qcmd(command, quota_type):
+    return (command << 8) | (quota_type & 0x00FF)
+
+
+class FsDiskQuota(ctypes.Structure):
+    """
+    struct fs_disk_quota, from <linux/dqblk_xfs.h>
+    """
+
+    _fields_ = [
+        ("d_version", ctypes.c_int8),
+        ("d_flags", ctypes.c_int8),
+        ("d_fieldmask", ctypes.c_uint16),
+        ("d_id", ctypes.c_uint32),
+        ("d_blk_hardlimit", ctypes.c_uint64),
+        ("d_blk_softlimit", ctypes.c_uint64),
+        ("d_ino_hardlimit", ctypes.c_uint64),
+        ("d_ino_softlimit", ctypes.c_uint64),
+        ("d_bcount", ctypes.c_uint64),
+        ("d_icount", ctypes.c_uint64),
+        ("d_itimer", ctypes.c_int32),
+        ("d_btimer", ctypes.c_int32),
+        ("d_iwarns", ctypes.c_uint16),
+        ("d_bwarns", ctypes.c_uint16),
+        ("d_itimer_hi", ctypes.c_int8),
+        ("d_btimer_hi", ctypes.c_int8),
+        ("d_rtbtimer_hi", ctypes.c_int8),
+        ("d_padding2", ctypes.c_int8),
+        ("d_rtb_hardlimit", ctypes.c_uint64),
+        ("d_rtb_softlimit", ctypes.c_uint64),
+        ("d_rtbcount", ctypes.c_uint64),
+        ("d_rtbtimer", ctypes.c_int32),
+        ("d_rtbwarns", ctypes.c_uint16),
+        ("d_padding3", ctypes.c_int16),
+        ("d_padding4", ctypes.c_char * 8),
+    ]
+
+    def to_record(self):
+        return QuotaRecord(
+            blocks_used=self.d_bcount // BASIC_BLOCKS_PER_KIB,
+            blocks_soft=self.d_blk_softlimit // BASIC_BLOCKS_PER_KIB,
+            blocks_hard=self.d_blk_hardlimit // BASIC_BLOCKS_PER_KIB,
+            inodes_used=self.d_icount,
+            inodes_soft=self.d_ino_softlimit,
+            inodes_hard=self.d_ino_hardlimit,
+            realtime_used=self.d_rtbcount // BASIC_BLOCKS_PER_KIB,
+            realtime_soft=self.d_rtb_softlimit // BASIC_BLOCKS_PER_KIB,
+            realtime_hard=self.d_rtb_hardlimit // BASIC_BLOCKS_PER_KIB,
+        )
+
+
+def find_block_device(mountpoint):
+    """
+    Return the block device of the XFS filesystem mounted at mountpoint, or None
+    """
+    device = None
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            # Fields are separated from the filesystem type and source by " - "
+            mount_fields, _, fs_fields = line.partition(" - ")
+            mount_path = mount_fields.split()[4]
+            fstype, source = fs_fields.split()[:2]
+            # Spaces and such are octal escaped
+            mount_path = re.sub(
+                r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), mount_path
+            )
+            # Later mounts on the same path shadow earlier ones
+            if mount_path == mountpoint:
+                device = source if fstype == "xfs" else None
+    return device
+
+
+class QuotactlBackend(XfsQuotaBackend):
+    """
+    Read and apply quotas with the quotactl system call, instead of running and parsing
+    the output of xfs_quota.
+
+    Project setup still runs xfs_quota. Filesystems where quotactl can't be used (for
+    example because the block device isn't visible to us) fall back to xfs_quota too.
+    """
+
+    # quotactl calls don't run a process, so run them (and any fallback) in a thread
+    async_get_applied_quotas = QuotaBackend.async_get_applied_quotas
+    async_set_limits = QuotaBackend.async_set_limits
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._libc.quotactl.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        # Mapping of mountpoints to block devices, or None if quotactl can't be used
+        self._devices = {}
+
+    def device_for(self, mountpoint):
+        """
+        Return the block device to pass to quotactl for mountpoint, or None if we should
+        fall back to xfs_quota
+        """
+        if mountpoint not in self._devices:
+            device = find_block_device(mountpoint)
+            if device is None or not os.path.exists(device):
+                self.log.warning(
+                    f"No block device found for {mountpoint}, using xfs_quota instead of quotactl"
+                )
+                device = None
+            self._devices[mountpoint] = device
+        return self._devices[mountpoint]
+
+    def disable(self, mountpoint, error):
+        self.log.warning(
+            f"quotactl failed for {mountpoint}, using xfs_quota instead",
+            exc_info=error,
+        )
+        self._devices[mountpoint] = None
+
+    def quotactl(self, command, device, id, dquot):
+        result = self._libc.quotactl(
+            qcmd(command, PRJQUOTA),
+            os.fsencode(device),
+            ctypes.c_int(id & 0xFFFFFFFF).value,
+            ctypes.addressof(dquot),
+        )
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), device)
+
+    def get_applied_quotas(self, mountpoints, projects):
+        paths_by_projid = {projid: path for path, projid in projects.items()}
+
+        quotas = QuotaTable()
+        fallback_mountpoints = []
+        for mountpoint in mountpoints:
+            device = self.device_for(mountpoint)
+            if device is None:
+                fallback_mountpoints.append(mountpoint)
+                continue
+
+            dquot = FsDiskQuota()
+            mount_quotas = []
+            id = 0
+            try:
+                while True:
+                    # Fetch the next project ID >= id that has a quota
+                    try:
+                        self.quotactl(Q_XGETNEXTQUOTA, device, id, dquot)
+                    except OSError as e:
+                        if e.errno == errno.ENOENT:
+                            break
+                        raise
+                    path = paths_by_projid.get(dquot.d_id, f"#{dquot.d_id}")
+                    mount_quotas.append((path, dquot.to_record()))
+                    if dquot.d_id == 0xFFFFFFFF:
+                        break
+                    id = dquot.d_id + 1
+            except OSError as e:
+                self.disable(mountpoint, e)
+                fallback_mountpoints.append(mountpoint)
+                continue
+            for path, record in mount_quotas:
+                quotas.set(path, record)
+
+        if fallback_mountpoints:
+            fallback_quotas = super().get_applied_quotas(fallback_mountpoints, projects)
+            for path, record in fallback_quotas.records():
+                quotas.set(path, record)
+        return quotas
+
+    def set_grace_period(self, mountpoint, seconds):
+        device = self.device_for(mountpoint)
+        if device is None:
+            return super().set_grace_period(mountpoint, seconds)
+
+        # The grace period is kept in the quota of project ID 0
+        dquot = FsDiskQuota(
+            d_version=FS_DQUOT_VERSION,
+            d_flags=FS_PROJ_QUOTA,
+            d_fieldmask=FS_DQ_BTIMER,
+            d_id=0,
+            d_btimer=seconds,
+        )
+        try:
+            self.quotactl(Q_XSETQLIM, device, 0, dquot)
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.ENOTBLK, errno.ENODEV):
+                raise
+            self.disable(mountpoint, e)
+            super().set_grace_period(mountpoint, seconds)
+
+    def set_limits(self, mountpoint, limits):
+        device = self.device_for(mountpoint)
+        if device is None:
+            return super().set_limits(mountpoint, limits)
+
+        succeeded = []
+        for i, (project, projid, intended) in enumerate(limits):
+            dquot = FsDiskQuota(
+                d_version=FS_DQUOT_VERSION,
+                d_flags=FS_PROJ_QUOTA,
+                d_fieldmask=FS_DQ_LIMIT_MASK,
+                d_id=projid,
+                d_blk_hardlimit=intended.blocks_hard * BASIC_BLOCKS_PER_KIB,
+                d_blk_softlimit=intended.blocks_soft * BASIC_BLOCKS_PER_KIB,
+                d_ino_hardlimit=intended.inodes_hard,
+                d_ino_softlimit=intended.inodes_soft,
+            )
+            try:
+                self.quotactl(Q_XSETQLIM, device, projid, dquot)
+            except OSError as e:
+                if e.errno in (errno.ENOSYS, errno.ENOTBLK, errno.ENODEV):
+                    # quotactl can't be used here at all
+                    self.disable(mountpoint, e)
+                    return succeeded + super().set_limits(mountpoint, limits[i:])
+                self.log.error(
+                    f"Setting up limit for {project} failed! Continuing...",
+                    exc_info=e,
+                )
+                continue
+            succeeded.append(project)
+        return succeeded
+
+
+class FakeQuotaBackend(QuotaBackend):
+    """
+    Keep project IDs and quotas in memory, instead of on an XFS filesystem.
+
+    This works on any filesystem and without privileges, for profiling and load testing
+    the QuotaManager with many home directories. Operations can be slowed down and made
+    to fail, like calls to xfs_quota can. Nothing is kept across restarts, and usage is
+    always reported as zero.
+    """
+
+    latency = Float(
+        default_value=0,
+        help="Number of seconds each operation takes, like a call to xfs_quota would",
+    ).tag(config=True)
+
+    setup_latency = Float(
+        default_value=0,
+        help="Additional number of seconds each project setup takes, like a tree walk",
+    ).tag(config=True)
+
+    failure_rate = Float(
+        default_value=0,
+        help="Probability between 0 and 1 of any operation on a project failing",
+    ).tag(config=True)
+
+    fail_projects = Set(
+        Unicode(),
+        help="Paths of projects whose setup and limits always fail",
+    ).tag(config=True)
+
+    tag_failed_setups = Bool(
+        default_value=False,
+        help=(
+            "Tag the top directory of projects whose setup fails, like xfs_quota does "
+            "when it fails or is killed partway through the tree walk"
+        ),
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Operations on projects run concurrently, from the setup threads
+        self._lock = threading.Lock()
+        # Mapping of project paths to (inode, project ID) of their directory
+        self._projects = {}
+        # Mapping of project IDs to the QuotaRecord of their limits
+        self._limits = {}
+        # Mapping of mountpoints to their grace period
+        self._grace_periods = {}
+        # (mtime, size) of the projid file & the project IDs in it
+        self._projids = ((), {})
+
+    def operation(self, command, project=None, *, latency=0):
+        """
+        Count and wait out an operation, raising CalledProcessError like xfs_quota if
+        it fails
+        """
+        metrics.SUBPROCESS_CALLS.labels(command=f"fake {command}").inc()
+        if self.latency or latency:
+            time.sleep(self.latency + latency)
+        try:
+            self.check_failure(command, project)
+        except subprocess.CalledProcessError:
+            metrics.SUBPROCESS_FAILURES.labels(command=f"fake {command}").inc()
+            raise
+
+    def check_failure(self, command, project=None):
+        """
+        Raise CalledProcessError if command should fail for project
+        """
+        if project in self.fail_projects or (
+            self.failure_rate and random.random() < self.failure_rate
+        ):
+            raise subprocess.CalledProcessError(1, ["fake", command, project or ""])
+
+    def projid_for(self, project):
+        """
+        Return the project ID of project in the projid file, like xfs_quota looks it up
+        """
+        stat = os.stat(self.projid_file)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._projids[0] != key:
+            projids = {}
+            with open(self.projid_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        path, projid = line.rsplit(":", 1)
+                        projids[path] = int(projid)
+            self._projids = (key, projids)
+        return self._projids[1].get(project)
+
+    def read_project(self, path):
+        inode = os.stat(path, follow_symlinks=False).st_ino
+        with self._lock:
+            recorded = self._projects.get(path)
+        if recorded is None or recorded[0] != inode:
+            # Never set up, or replaced by a new directory since
+            return (0, False)
+        return (recorded[1], True)
+
+    def setup_project(self, mountpoint, project):
+        projid = self.projid_for(project)
+        if projid is None:
+            raise subprocess.CalledProcessError(1, ["fake", "project", project])
+        inode = os.stat(project, follow_symlinks=False).st_ino
+        if self.tag_failed_setups:
+            # The top directory is tagged first, before walking the rest of the tree
+            with self._lock:
+                self._projects[project] = (inode, projid)
+        self.operation("project", project, latency=self.setup_latency)
+        with self._lock:
+            self._projects[project] = (inode, projid)
+
+    def get_applied_quotas(self, mountpoints, projects):
+        self.operation("report")
+        paths_by_projid = {projid: path for path, projid in projects.items()}
+        with self._lock:
+            projids = {projid for _, projid in self._projects.values()}
+            projids.update(self._limits)
+            limits = dict(self._limits)
+        quotas = QuotaTable()
+        for projid in sorted(projids):
+            path = paths_by_projid.get(projid, f"#{projid}")
+            quotas.set(path, limits.get(projid, QuotaRecord()))
+        return quotas
+
+    def set_grace_period(self, mountpoint, seconds):
+        self.operation("timer")
+        self._grace_periods[mountpoint] = seconds
+
+    def set_limits(self, mountpoint, limits):
+        self.operation("limit")
+        succeeded = []
+        for project, projid, intended in limits:
+            try:
+                self.check_failure("limit", project)
+                if self.projid_for(project) is None:
+                    raise subprocess.CalledProcessError(1, ["fake", "limit", project])
+            except (subprocess.CalledProcessError, OSError) as e:
+                self.log.error(
+                    f"Setting up limit for {project} failed! Continuing...",
+                    exc_info=e,
+                )
+                continue
+            with self._lock:
+                self._limits[projid] = QuotaRecord.from_limits(intended.limits())
+            succeeded.append(project)
+        return succeeded
@@ -0,0 +1,37 @@
+"""
+Read XFS project metadata of files directly, with the FS_IOC_FSGETXATTR ioctl.
+
+This is what `lsattr -p` does under the hood, without having to run (and parse
+the output of) a subprocess for every check.
+"""
+
+import fcntl
+import os
+import struct
+
+# _IOR('X', 31, struct fsxattr), from <linux/fs.h>
+FS_IOC_FSGETXATTR = 0x801C581F
+
+# Set on directories so that new files inside them inherit the project ID
+FS_XFLAG_PROJINHERIT = 0x00000200
+
+# struct fsxattr {
+#     __u32 fsx_xflags; __u32 fsx_extsize; __u32 fsx_nextents;
+#     __u32 fsx_projid; __u32 fsx_cowextsize; unsigned char fsx_pad[8];
+# }
+FSXATTR = struct.Struct("5I8x")
+
+
+def get_project(path):
+    """
+    Return a tuple of (project ID, inherit flag) for the file or directory at path
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    try:
+        buffer = bytearray(FSXATTR.size)
+        fcntl.ioctl(fd, FS_IOC_FSGETXATTR, buffer)
+    finally:
+        os.close(fd)
+
+    xflags, _extsize, _nextents, projid, _cowextsize = FSXATTR.unpack(buffer)
+    return projid, bool(xflags & FS_XFLAG_PROJINHERIT)
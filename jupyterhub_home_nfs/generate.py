@@ -11,9 +11,10 @@ is what we want for our hubs!
 
 This script can be run as a daemon in a machine acting as an
 NFS server, setting up quotas with XFS as each home directory appears.
-There can be a few seconds lag between the time the home directory appears
-and the quota is set, but that should be ok for now (we can fix that with
-inotify if we need to).
+By default there can be a few seconds lag between the time the home directory
+appears and the quota is set. With `use_inotify` enabled, new home directories
+are picked up as soon as they are created, and the periodic full reconciliation
+becomes a less frequent safety net.
 
 Your home directories must already be on an XFS file system, with prjquota
 mount option enabled.
@@ -30,27 +31,69 @@ This script *owns* /etc/projects and /etc/projid (or equivalent). If there are e
 there that aren't put in there by this script, they will be removed!
 """
 
+import asyncio
 import contextlib
-import itertools
-import logging
+import heapq
+import json
+import math
 import os
 import os.path
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-
-from prometheus_client import start_http_server
-from traitlets import Bool, Dict, Float, Int, List, Unicode
-from traitlets.config import Application
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import REGISTRY, start_http_server
+from traitlets import (
+    Any,
+    Bool,
+    Dict,
+    Float,
+    Instance,
+    Int,
+    List,
+    Set,
+    Tuple,
+    Type,
+    Unicode,
+    Union,
+    default,
+    observe,
+)
+from traitlets.config import Application, Config
+from traitlets.config.loader import JSONFileConfigLoader, PyFileConfigLoader
 
 from . import metrics
+from .api import start_api_server
+from .backends import QuotaBackend, XfsQuotaBackend
+from .inotify import DirectoryWatcher
+from .policy import QuotaPolicy, limit_traits, rule_traits
+from .quotas import MAX_VALUE, QuotaRecord, QuotaTable
 
 # Line at beginning of projid / projects file stating ownership
 OWNERSHIP_PREAMBLE = (
     "# This file is generated by jupyterhub-home-nfs. Do not modify by hand\n"
 )
 
+# Traits that decide the intended limits of each project
+POLICY_TRAITS = (
+    "hard_quota",
+    "soft_quota",
+    "inode_hard_quota",
+    "inode_soft_quota",
+    "exclude",
+    "quota_overrides",
+    "quota_tiers",
+    "quota_rules",
+)
+
+# Bumped whenever the layout of the state file changes, older state files are ignored
+STATE_VERSION = 1
+USAGE_EXPORT_VERSION = 1
+
 
 @contextlib.contextmanager
 def open_replace_atomic(path, *, mode="w"):
@@ -59,53 +102,94 @@ def open_replace_atomic(path, *, mode="w"):
     atomic writing."""
     path_dir, name = os.path.split(path)
     temp_fd, temp_path = tempfile.mkstemp(dir=path_dir, prefix=name)
-    with open(temp_path, mode) as f:
+    with os.fdopen(temp_fd, mode) as f:
         yield f
+        # Make sure the contents are on disk before they replace the old file
+        f.flush()
+        os.fsync(f.fileno())
     os.replace(temp_path, path)
 
 
-def logged_check_call(
-    args,
-    logger,
-    *,
-    log_stdout=True,
-    log_stderr=True,
-):
+def is_finite(value):
     """
-    Run `subprocess.check_call` with a logger to output stdio.
-    Return the stdout of the stream.
+    Return True if value is a number (but not a bool), and neither infinite nor NaN
     """
-    # Only record stderr if asked
-    stderr_kind = subprocess.PIPE if log_stderr else subprocess.DEVNULL
-    result = subprocess.run(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=stderr_kind,
-        encoding="utf8",
-        errors="surrogateescape",
-    )
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        # An int too large for a float
+        return False
+
 
-    # Set log level according to return code
-    log_level = logging.ERROR if result.returncode else logging.DEBUG
+class ProjidAllocator:
+    """
+    Hand out new project IDs in constant time.
+
+    New IDs go above the highest ID in use, or previously handed out (`high`, which
+    callers keep between allocators). With `reuse`, IDs that are released (and gaps
+    between `min_projid` and the highest ID handed out) are handed out again first,
+    lowest first.
+    """
 
-    # Handle stdout
-    if log_stdout:
-        for line in result.stdout.splitlines():
-            logger.log(log_level, line)
+    def __init__(self, used, min_projid, *, reuse=False, high=0):
+        self.used = set(used)
+        self.reuse = reuse
+        self.high = max(max(self.used, default=min_projid), high)
+        # Heap of released IDs, only kept with reuse
+        self.free = []
+        if reuse:
+            # Already sorted, and so a valid heap
+            self.free = [
+                projid
+                for projid in range(min_projid + 1, self.high)
+                if projid not in self.used
+            ]
 
-    # Handle stderr
-    if log_stderr:
-        for line in result.stderr.splitlines():
-            logger.log(log_level, line)
+    def allocate(self):
+        """
+        Return a new, unused project ID
+        """
+        if self.free:
+            projid = heapq.heappop(self.free)
+        else:
+            self.high += 1
+            projid = self.high
+        self.used.add(projid)
+        return projid
 
-    result.check_returncode()
-    return result.stdout
+    def release(self, projid):
+        """
+        Mark a project ID as no longer used
+        """
+        if projid in self.used:
+            self.used.remove(projid)
+            if self.reuse:
+                heapq.heappush(self.free, projid)
 
 
 class QuotaManager(Application):
     # Config file can be loaded from this location
     config_file = Unicode("", help="The config file to load").tag(config=True)
 
+    reload_config = Bool(
+        default_value=False,
+        help=(
+            "Watch config_file, and the files next to it (like other keys of a mounted "
+            "Kubernetes Secret), for changes. When they change, the quota policy "
+            "(hard_quota, soft_quota, inode_hard_quota, inode_soft_quota, exclude, "
+            "quota_overrides, quota_tiers and quota_rules) is reloaded, and limits are "
+            "re-applied to the projects whose intended quota changed. Changes to any "
+            "other configuration still need a restart, and are logged as a warning"
+        ),
+    ).tag(config=True)
+
+    config_check_interval = Float(
+        default_value=5,
+        help="Number of seconds between checks for config changes, with reload_config",
+    ).tag(config=True)
+
     # Define all configuration parameters as traitlets
     paths = List(
         Unicode(), default_value=[], help="Paths to scan for home directories"
@@ -124,10 +208,29 @@ class QuotaManager(Application):
         help="Project IDs will be generated starting from this number",
     ).tag(config=True)
 
+    reuse_projids = Bool(
+        default_value=False,
+        help=(
+            "Hand out project IDs of removed home directories to new ones. Off by "
+            "default, as files moved out of a removed home directory keep its project "
+            "ID, and would count towards the quota of the new one"
+        ),
+    ).tag(config=True)
+
     wait_time = Int(
         default_value=30, help="Number of seconds to wait between runs"
     ).tag(config=True)
 
+    use_inotify = Bool(
+        default_value=False,
+        help="Watch paths with inotify, reconciling as soon as home directories are created or removed",
+    ).tag(config=True)
+
+    full_reconcile_interval = Int(
+        default_value=600,
+        help="Number of seconds between full reconciliation runs when use_inotify is enabled",
+    ).tag(config=True)
+
     hard_quota = Float(
         default_value=10.0,
         help="Hard quota limit (in GiB) to set for all home directories",
@@ -139,10 +242,186 @@ class QuotaManager(Application):
         help="List of directory names to exclude setting quotas on",
     ).tag(config=True)
 
+    soft_quota = Float(
+        default_value=0,
+        help=(
+            "Soft quota limit (in GiB) to set for all home directories, 0 for none. Users "
+            "can go over it, up to the hard quota, for soft_quota_grace_period"
+        ),
+    ).tag(config=True)
+
+    soft_quota_grace_period = Int(
+        default_value=0,
+        help=(
+            "Number of seconds home directories may stay over their soft quota before "
+            "it is enforced like a hard quota. XFS only has one grace period per "
+            "filesystem for project quotas, so this applies to all home directories on "
+            "it. 0 leaves the filesystem's grace period (7 days by default) as it is"
+        ),
+    ).tag(config=True)
+
+    inode_hard_quota = Int(
+        default_value=0,
+        help=(
+            "Hard limit on the number of inodes (files, directories, etc) in each home "
+            "directory, 0 for no limit"
+        ),
+    ).tag(config=True)
+
+    inode_soft_quota = Int(
+        default_value=0,
+        help="Soft limit on the number of inodes in each home directory, 0 for no limit",
+    ).tag(config=True)
+
     quota_overrides = Dict(
-        value_trait=Float(),
+        value_trait=Union([Float(), Dict(per_key_traits=limit_traits())]),
+        default_value={},
+        help=(
+            "Dictionary mapping directory names to custom quota limits (in GiB), or to "
+            "dictionaries overriding any of hard_quota, soft_quota, inode_hard_quota and "
+            "inode_soft_quota"
+        ),
+    ).tag(config=True)
+
+    quota_tiers = Dict(
+        value_trait=Dict(per_key_traits=limit_traits()),
         default_value={},
-        help="Dictionary mapping directory names to custom quota limits (in GiB)",
+        help=(
+            "Dictionary mapping names of tiers to dictionaries of the limits "
+            "(hard_quota, soft_quota, inode_hard_quota and inode_soft_quota) they set, "
+            "for use in quota_rules"
+        ),
+    ).tag(config=True)
+
+    quota_rules = List(
+        Dict(per_key_traits=rule_traits()),
+        default_value=[],
+        help=(
+            "List of rules to pick limits for directories not in quota_overrides or "
+            "exclude. Each rule has either a glob 'pattern' or a 'regex' matching the "
+            "whole directory name, and sets either the limits of a 'tier', its own "
+            "limits (like quota_overrides), or none at all with 'exclude'. The first "
+            "matching rule is used, e.g. "
+            '[{"pattern": "instructor-*", "tier": "instructor"}]'
+        ),
+    ).tag(config=True)
+
+    quota_backend_class = Type(
+        default_value=XfsQuotaBackend,
+        klass=QuotaBackend,
+        help=(
+            "Class used to read and apply quotas. Use "
+            "jupyterhub_home_nfs.backends.QuotactlBackend to use the quotactl system call "
+            "instead of running xfs_quota where possible, or "
+            "jupyterhub_home_nfs.backends.FakeQuotaBackend to keep quotas in memory, for "
+            "testing and profiling without XFS"
+        ),
+    ).tag(config=True)
+
+    quota_backend = Instance(QuotaBackend)
+
+    @default("quota_backend")
+    def _default_quota_backend(self):
+        return self.quota_backend_class(
+            parent=self,
+            projects_file=self.projects_file,
+            projid_file=self.projid_file,
+        )
+
+    limit_batch_size = Int(
+        default_value=1000,
+        help="Maximum number of projects to set limits for in a single xfs_quota call",
+    ).tag(config=True)
+
+    max_parallel_setups = Int(
+        default_value=4,
+        help=(
+            "Maximum number of xfs_quota project setups, which walk whole home "
+            "directories, to run concurrently"
+        ),
+    ).tag(config=True)
+
+    setup_files_per_second = Float(
+        default_value=0,
+        help=(
+            "Maximum rate at which project setups may walk files, across all of them, "
+            "0 for no limit. Setups are started no faster than this allows, estimating "
+            "the files in each home directory from its inodes used in the last report. "
+            "See also the setup_nice and setup_ionice_class options of the quota backend"
+        ),
+    ).tag(config=True)
+
+    setup_time_budget = Float(
+        default_value=0,
+        help=(
+            "Maximum number of seconds to wait for xfs_quota project setups in each run, "
+            "0 for no limit. Setups still running after this carry on in the background, "
+            "and setups not started yet are deferred to the next run"
+        ),
+    ).tag(config=True)
+
+    use_asyncio = Bool(
+        default_value=False,
+        help=(
+            "Run quota reports, limit batches and project setups as asyncio "
+            "subprocesses, up to max_concurrent_commands (and max_parallel_setups for "
+            "setups) at a time. Setups run on an event loop in a background thread, so "
+            "setups still running when setup_time_budget runs out carry on in the "
+            "background, like without use_asyncio. See also the command_timeout and "
+            "setup_timeout options of the quota backend"
+        ),
+    ).tag(config=True)
+
+    max_concurrent_commands = Int(
+        default_value=4,
+        help="Maximum number of quota reports or limit batches to run at once, with use_asyncio",
+    ).tag(config=True)
+
+    verify_changed_projects_only = Bool(
+        default_value=False,
+        help="Only read project metadata of home directories whose inode change time changed since the last run",
+    ).tag(config=True)
+
+    append_projfiles = Bool(
+        default_value=False,
+        help=(
+            "Append entries for new home directories to the projid & projects files, "
+            "instead of rewriting both files whenever a home directory is added or removed. "
+            "Entries of removed home directories are left in place until more than "
+            "projfiles_compaction_threshold of them have accumulated"
+        ),
+    ).tag(config=True)
+
+    projfiles_compaction_threshold = Int(
+        default_value=100,
+        help=(
+            "With append_projfiles, rewrite the projid & projects files once more than "
+            "this many entries of removed home directories are left in them"
+        ),
+    ).tag(config=True)
+
+    state_file = Unicode(
+        default_value="",
+        help=(
+            "Path to save a snapshot of project IDs, applied limits and home directory "
+            "fingerprints to after each run, and restore them from on startup. "
+            "Keep this on persistent storage, e.g. next to the home directories, "
+            "so restarts don't reassign project IDs. Empty to disable"
+        ),
+    ).tag(config=True)
+
+    usage_export_file = Unicode(
+        default_value="",
+        help=(
+            "Path to periodically write the usage & limits of all home directories to, "
+            "as JSON, for the hub or dashboards to read without running xfs_quota "
+            "themselves. The file is replaced atomically. Empty to disable"
+        ),
+    ).tag(config=True)
+
+    usage_export_interval = Float(
+        default_value=60,
+        help="Minimum number of seconds between writes of usage_export_file",
     ).tag(config=True)
 
     uid = Int(
@@ -159,6 +438,116 @@ class QuotaManager(Application):
 
     enable_metrics = Bool(default_value=True, help="Enable prometheus metrics")
 
+    enable_api = Bool(
+        default_value=False,
+        help=(
+            "Serve an HTTP API to query the usage & limits of a home directory, reconcile "
+            "it immediately and set temporary overrides of its limits. Requires api_token"
+        ),
+    ).tag(config=True)
+
+    api_ip = Unicode(
+        default_value="127.0.0.1", help="IP address to serve the API on"
+    ).tag(config=True)
+
+    api_port = Int(default_value=7501, help="Port to serve the API on").tag(config=True)
+
+    api_token = Unicode(
+        help=(
+            "Token that API requests must present. Defaults to the "
+            "JUPYTERHUB_HOME_NFS_API_TOKEN environment variable"
+        ),
+    ).tag(config=True)
+
+    @default("api_token")
+    def _default_api_token(self):
+        return os.environ.get("JUPYTERHUB_HOME_NFS_API_TOKEN", "")
+
+    metrics_max_age = Float(
+        default_value=60,
+        help=(
+            "Maximum age (in seconds) of the directory usage served to metrics scrapes. "
+            "Older usage is still served, but refreshed in the background"
+        ),
+    ).tag(config=True)
+
+    # Last known state, kept between runs so changes can be reconciled incrementally.
+    # Mapping of home directory paths to project IDs, as last written to projid_file
+    _projects = Dict(allow_none=True, default_value=None)
+    # Highest project ID handed out so far, so IDs of removed home directories aren't
+    # handed out again unless reuse_projids is set
+    _projid_high = Int(0)
+    # Entries of the projid file as of when we last read or wrote it, and its
+    # (inode, size, mtime) then, see read_projfiles
+    _projfile_entries = Dict(allow_none=True, default_value=None)
+    _projfile_stat = Tuple()
+    # Entries of home directories that are gone, left in the projid file by
+    # append_projfiles until it is compacted
+    _stale_projects = Set()
+    # Modification times of paths and the home directories found in them, as of the
+    # last scan_homedirs
+    _homedirs_cache = Tuple()
+    # Project IDs & quotas applied on disk, as of the last full reconciliation plus
+    # any changes we have made since
+    _applied_projects = Dict()
+    _applied_quotas = Instance(QuotaTable, args=())
+    # Inode, size & modification time of the config files, see config_stamp
+    _config_stamp = Tuple()
+    # Config loaded from config_file when we started checking it for changes, to tell
+    # which changes need a restart
+    _initial_config = Instance(Config, allow_none=True)
+    # Compiled from the policy traits when first needed, see get_quota_policy
+    _quota_policy = Instance(QuotaPolicy, allow_none=True)
+    # Mapping of mount points to the grace period last set on them
+    _applied_grace_periods = Dict()
+    # Mapping of parent directories to (device, mount point), see mountpoint_for
+    _mountpoints = Dict()
+    # Mapping of home directories to ((inode, ctime), (project ID, inherit flag)) as
+    # of the last run, see get_applied_projects
+    _project_cache = Dict()
+    # Last state written to state_file, to avoid rewriting it when nothing changed
+    _saved_state = Unicode(allow_none=True, default_value=None)
+    # Project setups run in the background, see run_setups
+    _setup_executor = Instance(ThreadPoolExecutor, allow_none=True)
+    _setup_loop = Instance(asyncio.AbstractEventLoop, allow_none=True)
+    _running_setups = Dict()
+    # Home directories whose setup was deferred to the next run by setup_time_budget
+    _deferred_setups = Set()
+    # Home directories whose project setup was started, but hasn't succeeded since.
+    # xfs_quota tags the tree top-down, so a setup that failed or was killed partway
+    # leaves the home directory looking set up, see project_is_dirty
+    _incomplete_setups = Set()
+    # time.monotonic() at which setup_files_per_second allows the next setup to start,
+    # see reserve_setup
+    _next_setup_at = Float(0)
+    _setup_rate_lock = Any()
+    # (time.monotonic(), QuotaTable) served to metrics scrapes, see directory_quotas.
+    # Refreshes of it hold _snapshot_lock.
+    _quota_snapshot = Tuple()
+    _snapshot_lock = Any()
+    # time.monotonic() of the last write of usage_export_file
+    _usage_exported = Float(allow_none=True, default_value=None)
+    # Held while reconciling, so API requests and the main loop take turns. Released
+    # while waiting for project setups, see run_setups
+    _reconcile_lock = Any()
+    # Mapping of directory names to (limits, time.monotonic() they expire at or None),
+    # set through the API and taking priority over quota_overrides
+    _temporary_overrides = Dict()
+
+    @default("_snapshot_lock")
+    def _default_snapshot_lock(self):
+        return threading.Lock()
+
+    @default("_setup_rate_lock")
+    def _default_setup_rate_lock(self):
+        return threading.Lock()
+
+    @default("_reconcile_lock")
+    def _default_reconcile_lock(self):
+        # Reentrant, as reconcile_changes may fall back to reconcile_step. Waiting on the
+        # condition releases the lock however many times it is held.
+        return threading.Condition(threading.RLock())
+
     aliases = {
         "config-file": "QuotaManager.config_file",
         "paths": "QuotaManager.paths",
@@ -166,11 +555,13 @@ class QuotaManager(Application):
         "projid-file": "QuotaManager.projid_file",
         "min-projid": "QuotaManager.min_projid",
         "wait-time": "QuotaManager.wait_time",
+        "full-reconcile-interval": "QuotaManager.full_reconcile_interval",
         "hard-quota": "QuotaManager.hard_quota",
         "exclude": "QuotaManager.exclude",
         "quota-overrides": "QuotaManager.quota_overrides",
         "uid": "QuotaManager.uid",
         "gid": "QuotaManager.gid",
+        "state-file": "QuotaManager.state_file",
     }
 
     def initialize(self, argv=None):
@@ -186,12 +577,25 @@ class QuotaManager(Application):
         """
         Return mount point containing file / directory in path
 
-        xfs_quota wants to know which fs to operate on
+        xfs_quota wants to know which fs to operate on. All home directories in one of
+        paths share a mount point, so it is looked up once per parent directory and
+        cached until the device of that parent directory changes.
         """
-        result = logged_check_call(
-            ["df", "--output=target", os.fspath(path)], self.log, log_stdout=False
-        )
-        return result.strip().splitlines()[-1].strip()
+        parent = os.path.dirname(os.path.abspath(path))
+        device = os.stat(parent).st_dev
+
+        cached = self._mountpoints.get(parent)
+        if cached is not None and cached[0] == device:
+            return cached[1]
+
+        # Walk up until we cross onto another device
+        mountpoint = os.path.realpath(parent)
+        while not os.path.ismount(mountpoint):
+            mountpoint = os.path.dirname(mountpoint)
+
+        self.log.debug(f"Found mount point {mountpoint} for {parent}")
+        self._mountpoints[parent] = (device, mountpoint)
+        return mountpoint
 
     def parse_projids(self, path):
         """
@@ -210,20 +614,36 @@ class QuotaManager(Application):
                 projects[proj_path] = projid
         return projects
 
-    def reconcile_projfiles(self, *, is_dirty=False):
+    def is_homedir(self, path):
         """
-        Make sure each homedir in paths has an appropriate projid entry.
+        Check whether path is a home directory directly inside one of paths
+        """
+        name = os.path.basename(path)
+        if name.startswith(".") or not os.path.isdir(path):
+            return False
+        return any(os.path.join(base, name) == path for base in self.paths)
 
-        This 'owns' /etc/projects & /etc/projid (or equivalent) as well. If there are extra entries there,
-        they will be removed!
+    def scan_homedirs(self):
+        """
+        Fetch existing home directories in all paths, sorted to provide consistent
+        ordering across runs
+
+        Creating or removing a home directory changes the modification time of the path
+        it is in, so paths are only listed again when that changed since the last scan.
         """
-        # Fetch existing home directories
-        # Sort to provide consistent ordering across runs
         homedirs = []
+        stamps = []
         for path in self.paths:
             # Create the directory if it doesn't exist and make sure is owned by uid:gid
             os.makedirs(path, exist_ok=True)
             os.chown(path, self.uid, self.gid)
+            stamps.append(os.stat(path).st_mtime_ns)
+        stamps = tuple(stamps)
+
+        if self._homedirs_cache and self._homedirs_cache[0] == stamps:
+            return list(self._homedirs_cache[1])
+
+        for path in self.paths:
             for ent in os.scandir(path):
                 if ent.is_dir():
                     if ent.name.startswith("."):
@@ -232,139 +652,337 @@ class QuotaManager(Application):
                     homedirs.append(ent.path)
 
         homedirs.sort()
-        self.log.debug(f"homedirs: {homedirs}")
 
-        if is_dirty:
-            projects = {}
-            self.log.debug("Ignoring existing projects")
+        # A change made within the same clock tick as the scan leaves the modification
+        # time as it was, so only trust modification times that are safely in the past
+        if time.time_ns() - max(stamps, default=0) > 1_000_000_000:
+            self._homedirs_cache = (stamps, tuple(homedirs))
         else:
-            # Fetch list of projects in /etc/projid file, assumed to sync'd to /etc/projects file
-            projects = self.parse_projids(self.projid_file)
+            self._homedirs_cache = ()
+        return homedirs
 
-        self.log.debug(f"projects: {projects}")
+    def projid_allocator(self, projects):
+        """
+        Return a ProjidAllocator for new projects, given a mapping of existing projects
+        """
+        return ProjidAllocator(
+            projects.values(),
+            self.min_projid,
+            reuse=self.reuse_projids,
+            high=self._projid_high,
+        )
 
-        # We have to write /etc/projid & /etc/projects if they aren't completely in sync
-        projid_file_dirty = sorted(list(projects.keys())) != sorted(homedirs)
+    def remember_projfiles(self, entries):
+        """
+        Remember the entries we just wrote to the projid file, see read_projfiles
+        """
+        st = os.stat(self.projid_file)
+        self._projfile_stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self._projfile_entries = entries
 
-        if projid_file_dirty:
-            # Make sure /etc/projid & /etc/projects are in sync with home dirs
-            for home in homedirs:
-                if home in projects:
-                    continue
-                # Ensure an entry exists in projects
-                projects[home] = max(projects.values() or [self.min_projid]) + 1
-                self.log.debug(f"Found new project {home}")
+    def read_projfiles(self):
+        """
+        Return a mapping of paths to project IDs in the projid file.
 
-            # Remove projects that don't have corresponding homedirs
-            projects = {k: v for k, v in projects.items() if k in homedirs}
+        The file is only parsed again if its inode, size or modification time changed
+        since we last read or wrote it.
+        """
+        try:
+            st = os.stat(self.projid_file)
+        except FileNotFoundError:
+            return {}
+        if (
+            self._projfile_entries is None
+            or (st.st_ino, st.st_size, st.st_mtime_ns) != self._projfile_stat
+        ):
+            with metrics.PHASE_DURATION.labels(phase="projid_parse").time():
+                self._projfile_entries = self.parse_projids(self.projid_file)
+            self._projfile_stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return dict(self._projfile_entries)
 
-            with (
-                open_replace_atomic(self.projects_file) as projects_file,
-                open_replace_atomic(self.projid_file) as projid_file,
-            ):
-                projects_file.write(OWNERSHIP_PREAMBLE)
-                projid_file.write(OWNERSHIP_PREAMBLE)
-                for path, id in projects.items():
-                    projid_file.write(f"{path}:{id}\n")
-                    projects_file.write(f"{id}:{path}\n")
+    def write_projfiles(self, projects):
+        """
+        Atomically write /etc/projects & /etc/projid (or equivalent) for the given projects
+        """
+        with (
+            open_replace_atomic(self.projects_file) as projects_file,
+            open_replace_atomic(self.projid_file) as projid_file,
+        ):
+            projects_file.write(OWNERSHIP_PREAMBLE)
+            projid_file.write(OWNERSHIP_PREAMBLE)
+            for path, id in projects.items():
+                projid_file.write(f"{path}:{id}\n")
+                projects_file.write(f"{id}:{path}\n")
+        self.remember_projfiles(dict(projects))
+
+    def extend_projfiles(self, file_projects, new_projects):
+        """
+        Append entries for new projects to /etc/projects & /etc/projid (or equivalent).
 
-            self.log.debug(
-                f"Writing projid to {self.projid_file} and projects to {self.projects_file}"
+        `file_projects` is the mapping of projects already in the files.
+        """
+        for path, line_format in [
+            (self.projects_file, "{id}:{path}\n"),
+            (self.projid_file, "{path}:{id}\n"),
+        ]:
+            with open(path, "a") as f:
+                for project, id in new_projects.items():
+                    f.write(line_format.format(path=project, id=id))
+                f.flush()
+                os.fsync(f.fileno())
+        self.remember_projfiles({**file_projects, **new_projects})
+
+    def update_projfiles(self, file_projects, projects, added, *, rewrite=False):
+        """
+        Allocate project IDs for new home directories, and record them in /etc/projects
+        & /etc/projid (or equivalent).
+
+        `file_projects` is the mapping of projects currently in the files, `projects`
+        the mapping of home directories that keep their project ID and `added` the list
+        of new home directories. Entries in the files for anything else are stale. With
+        `append_projfiles`, new entries are appended and stale ones left in place until
+        there are too many of them. The files are rewritten in full otherwise, or when
+        `rewrite` is passed.
+
+        Sets self._projects to the resulting mapping.
+        """
+        added_set = set(added)
+        stale = {k for k in file_projects if k not in projects and k not in added_set}
+        rewrite = (
+            rewrite
+            or not self.append_projfiles
+            or len(stale) > self.projfiles_compaction_threshold
+            # Home directories that were removed and have come back need a new entry,
+            # and xfs_quota would use the first one for their name
+            or any(home in file_projects for home in added)
+            or not (
+                os.path.exists(self.projects_file) and os.path.exists(self.projid_file)
             )
+        )
 
-        # Finally, ensure we actually have these files
-        elif not (
-            os.path.exists(self.projects_file) or os.path.exists(self.projid_file)
-        ):
-            with (
-                open_replace_atomic(self.projects_file) as projects_file,
-                open_replace_atomic(self.projid_file) as projid_file,
+        allocator = self.projid_allocator(file_projects)
+        if rewrite:
+            # These entries are about to go away, so their IDs are free again
+            for home in stale | (added_set & file_projects.keys()):
+                allocator.release(file_projects[home])
+
+        projects = dict(projects)
+        new_projects = {}
+        for home in added:
+            new_projects[home] = projects[home] = allocator.allocate()
+            self.log.debug(f"Found new project {home}")
+        self._projid_high = allocator.high
+
+        if rewrite:
+            if stale or new_projects or file_projects.keys() != projects.keys():
+                self.log.debug(
+                    f"Writing projid to {self.projid_file} and projects to {self.projects_file}"
+                )
+                self.write_projfiles(projects)
+            elif not (
+                os.path.exists(self.projects_file) or os.path.exists(self.projid_file)
             ):
-                projects_file.write(OWNERSHIP_PREAMBLE)
-                projid_file.write(OWNERSHIP_PREAMBLE)
+                # Finally, ensure we actually have these files
+                self.write_projfiles(projects)
+            stale = set()
+        elif new_projects:
+            self.log.debug(
+                f"Appending {len(new_projects)} projects to {self.projid_file} and {self.projects_file}"
+            )
+            self.extend_projfiles(file_projects, new_projects)
+
+        self._stale_projects = stale
+        self._projects = projects
+        metrics.MANAGED_PROJECTS.set(len(projects))
+
+    def reconcile_projfiles(self, *, is_dirty=False):
+        """
+        Make sure each homedir in paths has an appropriate projid entry.
+
+        This 'owns' /etc/projects & /etc/projid (or equivalent) as well. If there are extra entries there,
+        they will be removed!
+        """
+        with metrics.PHASE_DURATION.labels(phase="scan").time():
+            homedirs = self.scan_homedirs()
+        self.log.debug("homedirs: %s", homedirs)
+
+        if is_dirty:
+            file_projects = {}
+            self.log.debug("Ignoring existing projects")
+        else:
+            # Fetch list of projects in /etc/projid file, assumed to sync'd to /etc/projects file
+            file_projects = self.read_projfiles()
+
+        self.log.debug("projects: %s", file_projects)
+
+        # Entries of home directories that were already gone when we last looked are
+        # stale, even if the home directory has since come back
+        homedir_set = set(homedirs)
+        projects = {
+            k: v
+            for k, v in file_projects.items()
+            if k in homedir_set and k not in self._stale_projects
+        }
+        added = [home for home in homedirs if home not in projects]
+
+        self.update_projfiles(file_projects, projects, added, rewrite=is_dirty)
 
     def get_applied_projects(self):
         """
         Determine existing applied project IDs
+
+        Reads the project ID & inherit flag of every home directory directly. Home
+        directories without the inherit flag set are left out, as new files created in
+        them would not be counted towards the quota.
+
+        With `verify_changed_projects_only`, directories whose inode number and change
+        time are the same as in the last run reuse the result from then. Setting project
+        metadata bumps the change time, so this only skips directories nobody has touched.
         """
-        try:
-            result = logged_check_call(
-                ["lsattr", "-p", *self.paths],
-                self.log,
-                log_stdout=False,
-            )
-        except subprocess.CalledProcessError as e:
-            self.log.error(
-                f"Checking project metadata for paths {self.paths} failed! Continuing...",
-                exc_info=e,
-            )
+        applied_projects = {}
+        checked = {}
+        for path in self.paths:
+            try:
+                entries = list(os.scandir(path))
+            except OSError as e:
+                self.log.error(
+                    f"Listing home directories in {path} failed! Continuing...",
+                    exc_info=e,
+                )
+                continue
 
-            return {}
+            for ent in entries:
+                if ent.name.startswith("."):
+                    continue
+                try:
+                    if not ent.is_dir(follow_symlinks=False):
+                        continue
+                    stat = ent.stat(follow_symlinks=False)
+                    fingerprint = (stat.st_ino, stat.st_ctime_ns)
+                    cached = self._project_cache.get(ent.path)
+                    if (
+                        self.verify_changed_projects_only
+                        and cached is not None
+                        and cached[0] == fingerprint
+                    ):
+                        result = cached[1]
+                    else:
+                        result = self.quota_backend.read_project(ent.path)
+                except OSError as e:
+                    # Don't let one bad entry stop us from checking the others
+                    self.log.error(
+                        f"Checking project metadata for {ent.path} failed! Continuing...",
+                        exc_info=e,
+                    )
+                    continue
 
-        return {
-            path: int(projid)
-            for projid, _, path in (
-                line.split(None, maxsplit=2) for line in result.strip().splitlines()
-            )
-        }
+                checked[ent.path] = (fingerprint, result)
+                projid, inherit = result
+                if inherit:
+                    applied_projects[ent.path] = projid
 
-    def get_applied_quotas(self):
+        self._project_cache = checked
+        return applied_projects
+
+    def get_applied_quotas(self, projects=None):
         """
         Determine existing applied quotas
+
+        `projects` is a mapping of project paths to project IDs, read from the projid
+        file if not given.
         """
-        result = logged_check_call(
-            [
-                "xfs_quota",
-                "-x",
-                "-c",
-                "report -N -p -bir",
-                "-D",
-                f"{self.projects_file}",
-                "-P",
-                f"{self.projid_file}",
-            ],
-            self.log,
-            log_stdout=False,
-        )
+        if projects is None:
+            projects = self.parse_projids(self.projid_file)
+        mountpoints = sorted({self.mountpoint_for(path) for path in projects})
+        if self.use_asyncio:
+            return asyncio.run(self.async_get_applied_quotas(mountpoints, projects))
+        return self.quota_backend.get_applied_quotas(mountpoints, projects)
 
-        # Parse a collection of quotas (e.g. blocks, inodes)
-        def parse_collection(quotas):
-            used, soft, hard, warn, grace = itertools.islice(quotas, 5)
-            return {"soft": int(soft), "hard": int(hard), "used": int(used)}
-
-        quotas = {}
-        for line in result.strip().splitlines():
-            parts = line.split()
-            # There are always 15 items at the end of the xfs_quota command output:
-            # 5 items (used, soft, hard, warn, grace) for each of Blocks, Inodes and Realtime
-            items = iter(parts[-15:])
-            # The path (Project Id) is what's left to the left of these items
-            path = "".join(parts[:-15])
-            blocks = parse_collection(items)
-            inodes = parse_collection(items)
-            realtime = parse_collection(items)
-            # Everything here is in kb, since that's what xfs_quota reports things in
-            quotas[path] = {"blocks": blocks, "inodes": inodes, "realtime": realtime}
+    async def async_get_applied_quotas(self, mountpoints, projects):
+        """
+        Read the quotas on each of mountpoints concurrently, into one QuotaTable
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_commands)
 
+        async def report(mountpoint):
+            async with semaphore:
+                return await self.quota_backend.async_get_applied_quotas(
+                    [mountpoint], projects
+                )
+
+        quotas = QuotaTable()
+        for mount_quotas in await asyncio.gather(*map(report, mountpoints)):
+            for path, record in mount_quotas.records():
+                quotas.set(path, record)
         return quotas
 
-    def quota_is_dirty(self, quotas, intended_block_quota):
+    def quota_is_dirty(self, record, intended):
         """
         Determine whether the filesystem quota values are dirty with respect to intended quotas
+
+        Both are QuotaRecords, and all limits (not just the ones we set) are compared,
+        so limits set out-of-band are cleared.
+        """
+        return record.limits() != intended.limits()
+
+    def update_metrics(self, applied_quotas: QuotaTable):
+        """
+        Replace the quotas served to metrics scrapes, see directory_quotas
+        """
+        self._quota_snapshot = (time.monotonic(), applied_quotas)
+
+    def refresh_quota_snapshot(self):
         """
-        if quotas["blocks"]["hard"] != intended_block_quota:
-            return True
+        Fetch quotas of the current projects for metrics, in the background.
 
-        # Have any other quotas changed?
-        return any(
-            quotas[group][kind]
-            for group, kind in itertools.product(
-                ("inodes", "realtime"), ("hard", "soft")
+        Called with _snapshot_lock held, which is released once done.
+        """
+        try:
+            # Leave out home directories removed since the last reconciliation
+            projects = {
+                project: projid
+                for project, projid in (self._projects or {}).items()
+                if os.path.isdir(project)
+            }
+            quotas = self.get_applied_quotas(projects)
+            for project in [p for p in quotas if p not in projects]:
+                quotas.discard(project)
+        except Exception as e:
+            self.log.error(
+                "Refreshing quotas for metrics failed! Continuing...", exc_info=e
             )
-        )
+        else:
+            self.update_metrics(quotas)
+        finally:
+            self._snapshot_lock.release()
+
+    def directory_quotas(self):
+        """
+        Return a list of (directory name, QuotaRecord) to serve to metrics scrapes.
+
+        This never waits for quotas to be read. If the last snapshot is older than
+        `metrics_max_age`, it is served as is and refreshed in the background.
+        """
+        if self._quota_snapshot:
+            taken, quotas = self._quota_snapshot
+        else:
+            taken, quotas = None, QuotaTable()
 
-    def update_metrics(self, applied_quotas: dict[str, dict]):
-        for directory_path, quotas in applied_quotas.items():
+        if (
+            self._projects is not None
+            and (taken is None or time.monotonic() - taken > self.metrics_max_age)
+            and self._snapshot_lock.acquire(blocking=False)
+        ):
+            threading.Thread(
+                target=self.refresh_quota_snapshot, name="metrics-refresh", daemon=True
+            ).start()
+
+        projects = self._projects or {}
+        directory_quotas = []
+        for directory_path, record in quotas.records():
+            if directory_path not in projects:
+                # This home directory is gone, or a stale entry in the projid file
+                continue
             # Let's determine directory name to not be the full path (as that's an implementation detail)
             # but just the specific path that's beyond the common base path.
             directory_name = None
@@ -377,52 +995,443 @@ class QuotaManager(Application):
             if directory_name is None:
                 # This isn't managed by us
                 continue
-            # xfs_quotas sets things in KB, so let's convert it to bytes
-            metrics.HARD_LIMIT.labels(directory=directory_name).set(
-                quotas["blocks"]["hard"] * 1024
+            directory_quotas.append((directory_name, record))
+        return directory_quotas
+
+    def get_quota_policy(self):
+        """
+        Return the QuotaPolicy compiled from the current configuration
+        """
+        if self._quota_policy is None:
+            self._quota_policy = QuotaPolicy(
+                {
+                    "hard_quota": self.hard_quota,
+                    "soft_quota": self.soft_quota,
+                    "inode_hard_quota": self.inode_hard_quota,
+                    "inode_soft_quota": self.inode_soft_quota,
+                },
+                overrides={
+                    **self.quota_overrides,
+                    **{
+                        name: limits
+                        for name, (limits, _) in self._temporary_overrides.items()
+                    },
+                },
+                exclude=self.exclude,
+                rules=self.quota_rules,
+                tiers=self.quota_tiers,
             )
-            metrics.TOTAL_SIZE.labels(directory=directory_name).set(
-                quotas["blocks"]["used"] * 1024
+        return self._quota_policy
+
+    @observe(*POLICY_TRAITS)
+    def _reset_quota_policy(self, change):
+        self._quota_policy = None
+
+    def intended_quota(self, project):
+        """
+        Return the limits that should be set for the project at path `project`, as a QuotaRecord
+        """
+        return self.get_quota_policy().intended_quota(os.path.basename(project))
+
+    def project_is_dirty(self, project, projid, intended):
+        """
+        Determine whether a project needs to be set up again, according to the last known
+        applied project IDs and quotas
+        """
+        record = self._applied_quotas.record(project)
+        return (
+            # Check project ID mapping is valid
+            self._applied_projects.get(project) != projid
+            # Check the last setup went all the way through the tree
+            or project in self._incomplete_setups
+            # Check quotas are valid
+            or record is None
+            or self.quota_is_dirty(record, intended)
+        )
+
+    def record_applied_quota(self, project, projid, intended):
+        """
+        Update the last known applied state after successfully setting up a project
+        """
+        self._applied_projects[project] = projid
+        record = self._applied_quotas.record(project) or QuotaRecord()
+        # Usage stays as it was, limits are now the intended ones
+        self._applied_quotas.set(
+            project,
+            intended._replace(
+                blocks_used=record.blocks_used,
+                inodes_used=record.inodes_used,
+                realtime_used=record.realtime_used,
+            ),
+        )
+
+    def reserve_setup(self, project):
+        """
+        Return how many seconds to wait before setting up `project`, to stay within
+        setup_files_per_second.
+
+        The files in the project are estimated from its inodes used in the last quota
+        report, and reserved from the budget right away.
+        """
+        if not self.setup_files_per_second:
+            return 0
+        record = self._applied_quotas.record(project)
+        files = record.inodes_used if record else 0
+        with self._setup_rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_setup_at)
+            self._next_setup_at = start + files / self.setup_files_per_second
+        delay = start - now
+        if delay > 0:
+            metrics.SETUP_THROTTLE.inc(delay)
+            self.log.debug(f"Waiting {delay:.1f}s to set up {project}")
+        return delay
+
+    def setup_project(self, project):
+        """
+        Set up the xfs_quota project for `project`, tagging every file in it with its project ID.
+
+        Returns True if this succeeded.
+        """
+        mountpoint = self.mountpoint_for(project)
+        delay = self.reserve_setup(project)
+        if delay > 0:
+            time.sleep(delay)
+        self.log.info(f"Setting up xfs_quota project for {project}")
+        self._incomplete_setups.add(project)
+        start = time.monotonic()
+        try:
+            self.quota_backend.setup_project(mountpoint, project)
+        except (subprocess.SubprocessError, OSError) as e:
+            metrics.SETUP_DURATION.labels(result="failure").observe(
+                time.monotonic() - start
             )
+            self.log.error(
+                f"Setting up project for {project} failed! Continuing...",
+                exc_info=e,
+            )
+            return False
+        metrics.SETUP_DURATION.labels(result="success").observe(
+            time.monotonic() - start
+        )
+        self._incomplete_setups.discard(project)
+        return True
+
+    async def async_setup_project(self, project):
+        """
+        Like setup_project, without blocking the event loop
+        """
+        mountpoint = self.mountpoint_for(project)
+        delay = self.reserve_setup(project)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.log.info(f"Setting up xfs_quota project for {project}")
+        self._incomplete_setups.add(project)
+        start = time.monotonic()
+        try:
+            await self.quota_backend.async_setup_project(mountpoint, project)
+        except (subprocess.SubprocessError, OSError) as e:
+            metrics.SETUP_DURATION.labels(result="failure").observe(
+                time.monotonic() - start
+            )
+            self.log.error(
+                f"Setting up project for {project} failed! Continuing...",
+                exc_info=e,
+            )
+            return False
+        metrics.SETUP_DURATION.labels(result="success").observe(
+            time.monotonic() - start
+        )
+        self._incomplete_setups.discard(project)
+        return True
+
+    def set_limits(self, projects, intended_quotas):
+        """
+        Set limits for many projects, in as few calls to the backend as possible.
+
+        `projects` is a mapping of project paths to project IDs, and `intended_quotas`
+        a mapping of project paths to QuotaRecords with the limits to set.
+        Returns the set of projects that limits were successfully set for.
+        """
+        # Quotas are set on one filesystem at a time
+        limits_by_mountpoint = {}
+        for project, intended in intended_quotas.items():
+            self.log.info(
+                f"Setting limits for project {project} to bhard={intended.blocks_hard}k "
+                f"bsoft={intended.blocks_soft}k ihard={intended.inodes_hard} "
+                f"isoft={intended.inodes_soft}"
+            )
+            limits_by_mountpoint.setdefault(self.mountpoint_for(project), []).append(
+                (project, projects[project], intended)
+            )
+
+        batches = [
+            (mountpoint, limits[i : i + self.limit_batch_size])
+            for mountpoint, limits in limits_by_mountpoint.items()
+            for i in range(0, len(limits), self.limit_batch_size)
+        ]
+        if self.use_asyncio:
+            return asyncio.run(self.async_set_limits(batches))
+
+        succeeded = set()
+        for mountpoint, batch in batches:
+            succeeded.update(self.quota_backend.set_limits(mountpoint, batch))
+        return succeeded
+
+    async def async_set_limits(self, batches):
+        """
+        Set limits for batches of (mountpoint, limits) concurrently, see set_limits
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_commands)
+
+        async def set_batch(mountpoint, batch):
+            async with semaphore:
+                return await self.quota_backend.async_set_limits(mountpoint, batch)
+
+        results = await asyncio.gather(*(set_batch(*batch) for batch in batches))
+        return {project for succeeded in results for project in succeeded}
+
+    def setup_priority(self, project, projid):
+        """
+        Sort key for scheduling project setups, cheapest and unprotected first.
+
+        Home directories that aren't (completely) tagged with their project ID have no
+        working quota, so they go before re-setups of already protected ones. The inodes used
+        in the last quota report estimate how long the tree walk will take. Home
+        directories missing from the report are new, and assumed to be empty.
+        """
+        record = self._applied_quotas.record(project)
+        inodes_used = record.inodes_used if record else 0
+        protected = (
+            self._applied_projects.get(project) == projid
+            and project not in self._incomplete_setups
+        )
+        return (protected, inodes_used)
+
+    def run_setups(self, projects, intended_quotas, limited):
+        """
+        Set up projects concurrently, cheapest first, within the setup time budget.
+
+        Up to `max_parallel_setups` projects are set up at once. Each worker picks up
+        the next project as soon as it is done, so one huge home directory only ever
+        holds up a single worker. Once `setup_time_budget` runs out, we stop waiting:
+        setups that are still running carry on in the background, and those that
+        haven't started yet are left for the next run to pick up.
+
+        The reconcile lock is released while waiting for setups, so API requests
+        aren't held up by tree walks. Setups of the same projects that are already
+        running, e.g. from the main loop, are waited for instead of started again.
+        """
+        started = {}
+        for project in intended_quotas:
+            future = self._running_setups.get(project)
+            if future is not None and not future.done():
+                started[future] = project
+        running = set(started.values())
+        pending = deque(
+            sorted(
+                (p for p in intended_quotas if p not in running),
+                key=lambda project: self.setup_priority(project, projects[project]),
+            )
+        )
+
+        deadline = (
+            time.monotonic() + self.setup_time_budget
+            if self.setup_time_budget
+            else None
+        )
+
+        def can_progress():
+            self.forget_finished_setups()
+            return any(future.done() for future in started) or (
+                pending and len(self._running_setups) < self.max_parallel_setups
+            )
+
+        with self._reconcile_lock:
+            while pending or started:
+                while pending and len(self._running_setups) < self.max_parallel_setups:
+                    project = pending.popleft()
+                    future = self.start_setup(project)
+                    self._running_setups[project] = future
+                    started[future] = project
+
+                timeout = (
+                    None if deadline is None else max(deadline - time.monotonic(), 0)
+                )
+                self._reconcile_lock.wait_for(can_progress, timeout)
+                for future in [future for future in started if future.done()]:
+                    project = started.pop(future)
+                    if (
+                        future.result()
+                        and project in limited
+                        # API requests may have removed the home directory, or changed
+                        # its limits, while we waited
+                        and (self._projects or {}).get(project) == projects[project]
+                        and self.intended_quota(project) == intended_quotas[project]
+                    ):
+                        self.record_applied_quota(
+                            project, projects[project], intended_quotas[project]
+                        )
+
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+
+            self._deferred_setups = (
+                self._deferred_setups - intended_quotas.keys()
+            ) | set(pending)
+        if pending or started:
+            self.log.info(
+                f"Setup time budget used up, leaving {len(started)} project setups running "
+                f"and deferring {len(pending)} to the next run"
+            )
+
+    def forget_finished_setups(self):
+        """
+        Remove finished setups from the running ones.
+
+        Whoever started or joined a setup handles its outcome. Setups that finished
+        after the run that started them stopped waiting are reflected in the applied
+        projects read by the next run.
+        """
+        if any(future.done() for future in self._running_setups.values()):
+            self._running_setups = {
+                project: future
+                for project, future in self._running_setups.items()
+                if not future.done()
+            }
+
+    def update_setup_backlog(self):
+        """
+        Update the setup backlog metric, with setups that finished in the background since
+        """
+        with self._reconcile_lock:
+            self.forget_finished_setups()
+            metrics.SETUP_BACKLOG.set(
+                len(self._running_setups) + len(self._deferred_setups)
+            )
+
+    def notify_setup_done(self, future):
+        """
+        Wake up run_setups, waiting for setups to finish
+        """
+        with self._reconcile_lock:
+            self._reconcile_lock.notify_all()
+
+    def start_setup(self, project):
+        """
+        Start setting up `project` in the background, returning a Future of whether
+        it succeeded.
+
+        Setups run in a pool of threads, or with use_asyncio as tasks on an event loop
+        in a background thread. Either way, they can outlive the run that started them.
+        """
+        if self.use_asyncio:
+            if self._setup_loop is None:
+                self._setup_loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._setup_loop.run_forever, name="setup", daemon=True
+                ).start()
+            future = asyncio.run_coroutine_threadsafe(
+                self.async_setup_project(project), self._setup_loop
+            )
+            # Done callbacks run on the event loop, which must not wait for the lock
+            future.add_done_callback(
+                lambda future: threading.Thread(
+                    target=self.notify_setup_done, args=(future,), daemon=True
+                ).start()
+            )
+            return future
+
+        if self._setup_executor is None:
+            self._setup_executor = ThreadPoolExecutor(
+                max_workers=self.max_parallel_setups, thread_name_prefix="setup"
+            )
+        future = self._setup_executor.submit(self.setup_project, project)
+        future.add_done_callback(self.notify_setup_done)
+        return future
+
+    def apply_quotas(self, projects, intended_quotas, *, force_setup=False):
+        """
+        Set up projects and set their hard quotas.
+
+        `projects` is a mapping of project paths to project IDs, and `intended_quotas`
+        a mapping of project paths to QuotaRecords with the limits to apply.
+
+        Limits are keyed on project ID, not on directories, so they are all set first in
+        a few batched calls. Every home directory is then protected as soon as its
+        (potentially slow) project setup completes. Directories that a completed setup
+        already tagged with the correct project ID only need their limits set, unless
+        `force_setup` is passed.
+        """
+        limited = self.set_limits(projects, intended_quotas)
+
+        needs_setup = {}
+        for project, intended in intended_quotas.items():
+            if (
+                force_setup
+                or self._applied_projects.get(project) != projects[project]
+                or project in self._incomplete_setups
+            ):
+                needs_setup[project] = intended
+            elif project in limited:
+                self.record_applied_quota(project, projects[project], intended)
+
+        if needs_setup:
+            self.run_setups(projects, needs_setup, limited)
+        self.update_setup_backlog()
+
+    def apply_grace_periods(self, projects):
+        """
+        Set soft_quota_grace_period on the filesystems of projects, where it isn't yet
+        """
+        for mountpoint in sorted({self.mountpoint_for(path) for path in projects}):
+            if (
+                self._applied_grace_periods.get(mountpoint)
+                == self.soft_quota_grace_period
+            ):
+                continue
+            self.log.info(
+                f"Setting soft quota grace period for {mountpoint} to {self.soft_quota_grace_period}s"
+            )
+            try:
+                self.quota_backend.set_grace_period(
+                    mountpoint, self.soft_quota_grace_period
+                )
+            except (subprocess.SubprocessError, OSError) as e:
+                self.log.error(
+                    f"Setting grace period for {mountpoint} failed! Continuing...",
+                    exc_info=e,
+                )
+                continue
+            self._applied_grace_periods[mountpoint] = self.soft_quota_grace_period
 
     def reconcile_quotas(self, *, is_dirty=False):
         """
         Make sure each project in /etc/projid has correct hard quota set
         """
-        # Convert GiB to KiB for xfs_quota
-        hard_quota_kb = int(self.hard_quota * 1024 * 1024)
-        # Convert quota_overrides from GiB to KiB
-        quota_overrides_kb = {
-            dirname: int(quota_gb * 1024 * 1024)
-            for dirname, quota_gb in self.quota_overrides.items()
-        }
-
-        # Get current set of projects on disk
-        projects = self.parse_projids(self.projid_file)
+        # Get current set of projects, leaving out stale entries in the projid file
+        if self._projects is None:
+            projects = self.read_projfiles()
+        else:
+            projects = dict(self._projects)
 
         # Fetch quota information from filesystem
-        applied_quotas = self.get_applied_quotas()
-        applied_projects = self.get_applied_projects()
-
-        self.update_metrics(applied_quotas)
-
-        self.log.debug(f"Applied quotas: {applied_quotas}")
-
-        # Set quotas based on priority: quota_overrides > exclude_dirs > hard_quota_kb
-        intended_quotas = {}
-        for project in projects:
-            dirname = os.path.basename(project)
-            if dirname in quota_overrides_kb:
-                # Override takes highest priority
-                intended_quotas[project] = quota_overrides_kb[dirname]
-            elif dirname in self.exclude:
-                # Exclude means 0 quota
-                intended_quotas[project] = 0
-            else:
-                # Default quota
-                intended_quotas[project] = hard_quota_kb
+        with metrics.PHASE_DURATION.labels(phase="report").time():
+            quotas = self.get_applied_quotas(projects)
+        # Metrics are served from this snapshot from other threads, so it must not change
+        self.update_metrics(quotas)
+        self._applied_quotas = quotas.copy()
+        with metrics.PHASE_DURATION.labels(phase="project_read").time():
+            self._applied_projects = self.get_applied_projects()
+
+        # Formatting these is expensive with many projects, so only do it when needed
+        self.log.debug("Applied quotas: %s", self._applied_quotas)
+
+        intended_quotas = {
+            project: self.intended_quota(project) for project in projects
+        }
 
-        self.log.debug(f"Intended quotas: {intended_quotas}")
+        self.log.debug("Intended quotas: %s", intended_quotas)
 
         # Allow quotas to be forcibly treated as dirty
         if is_dirty:
@@ -432,85 +1441,621 @@ class QuotaManager(Application):
             changed_projects = [
                 p
                 for p, projid in projects.items()
-                # Check project ID mapping is valid
-                if applied_projects.get(p) != projid
-                # Check quotas are valid
-                or p not in applied_quotas
-                or self.quota_is_dirty(applied_quotas[p], intended_quotas[p])
+                if self.project_is_dirty(p, projid, intended_quotas[p])
             ]
 
+        metrics.DIRTY_PROJECTS.set(len(changed_projects))
+        # Deferred setups that are no longer needed, e.g. of removed home directories
+        self._deferred_setups = self._deferred_setups & set(changed_projects)
+
+        if self.soft_quota_grace_period:
+            self.apply_grace_periods(projects)
+
         # Adjust quotas for projects that don't the correct quota set
-        if not changed_projects:
+        with metrics.PHASE_DURATION.labels(phase="apply").time():
+            self.apply_quotas(
+                projects,
+                {project: intended_quotas[project] for project in changed_projects},
+                # Home directories that are tagged already are set up again too
+                force_setup=is_dirty,
+            )
+
+    def save_state(self):
+        """
+        Save a snapshot of what we know about projects to state_file, if set.
+
+        For every project, this records its project ID, the (inode, ctime) fingerprint
+        and project metadata of its home directory, and the limits applied to it.
+        Projects whose setup hasn't completed are recorded too, so they are set up
+        again after a restart.
+        """
+        if not self.state_file or self._projects is None:
             return
 
-        for project in changed_projects:
-            mountpoint = self.mountpoint_for(project)
-            self.log.info(f"Setting up xfs_quota project for {project}")
+        projects = {}
+        for project, projid in self._projects.items():
+            cached = self._project_cache.get(project)
+            record = self._applied_quotas.record(project)
+            projects[project] = [
+                projid,
+                [*cached[0], *cached[1]] if cached else None,
+                record.limits() if record else None,
+            ]
+        state = json.dumps(
+            {
+                "version": STATE_VERSION,
+                "paths": self.paths,
+                "projects": projects,
+                "projid_high": self._projid_high,
+                # Setup threads add to this while we read it, so copy it first
+                "incomplete_setups": sorted(
+                    p for p in list(self._incomplete_setups) if p in projects
+                ),
+            },
+            separators=(",", ":"),
+        )
+        if state == self._saved_state:
+            return
+
+        try:
+            with open_replace_atomic(self.state_file) as f:
+                f.write(state)
+        except OSError as e:
+            self.log.error(
+                f"Saving state to {self.state_file} failed! Continuing...", exc_info=e
+            )
+            return
+        self._saved_state = state
+
+    def load_state(self):
+        """
+        Restore the snapshot saved by save_state in an earlier run, if there is one.
+
+        The snapshot is only trusted as far as a stat of each home directory confirms:
+        directories that are gone, or have been replaced by a different inode, are left
+        out. If the projid file is missing (e.g. because it lives on ephemeral storage),
+        it is rewritten from the snapshot so no project IDs get reassigned, and no home
+        directory needs a full project setup again.
+
+        Returns True if a snapshot was restored.
+        """
+        if not self.state_file:
+            return False
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            self.log.warning(
+                f"Reading state from {self.state_file} failed, ignoring it", exc_info=e
+            )
+            return False
+
+        if state.get("version") != STATE_VERSION or state.get("paths") != self.paths:
+            self.log.info(f"State in {self.state_file} is out of date, ignoring it")
+            return False
+
+        projects = {}
+        project_cache = {}
+        applied_quotas = QuotaTable()
+        for project, (projid, fingerprint, limits) in state["projects"].items():
             try:
-                logged_check_call(
-                    [
-                        "xfs_quota",
-                        "-x",
-                        "-c",
-                        f"project -s {project}",
-                        "-D",
-                        f"{self.projects_file}",
-                        "-P",
-                        f"{self.projid_file}",
-                        mountpoint,
-                    ],
-                    self.log,
-                    # stderr can be huge for this call, because it includes verbose per-file information
-                    # let's exclude it to avoid OOM errors with large amounts of string processing'
-                    log_stderr=False,
-                )
-            except subprocess.CalledProcessError as e:
-                self.log.error(
-                    f"Setting up project for {project} failed! Continuing...",
-                    exc_info=e,
-                )
+                inode = os.stat(project, follow_symlinks=False).st_ino
+            except OSError:
+                # Removed while we weren't running
                 continue
+            if fingerprint is not None:
+                if fingerprint[0] != inode:
+                    # Replaced by a different directory, which has to be set up again
+                    continue
+                project_cache[project] = (
+                    tuple(fingerprint[:2]),
+                    (fingerprint[2], bool(fingerprint[3])),
+                )
+            projects[project] = projid
+            if limits is not None:
+                applied_quotas.set(project, QuotaRecord.from_limits(limits))
 
+        if not os.path.exists(self.projid_file):
             self.log.info(
-                f"Setting limit for project {project} to {intended_quotas[project]}k"
+                f"Restoring {len(projects)} project IDs from {self.state_file}"
+            )
+            self.write_projfiles(projects)
+        self._project_cache = project_cache
+        self._applied_quotas = applied_quotas
+        self._incomplete_setups = {
+            project
+            for project in state.get("incomplete_setups", [])
+            if project in projects
+        }
+        self._projid_high = max(self._projid_high, state.get("projid_high", 0))
+        return True
+
+    def reconcile_step(self, *, projfiles_is_dirty=False, quotas_is_dirty=False):
+        with self._reconcile_lock:
+            self.expire_overrides(reconcile=False)
+            with metrics.RECONCILE_DURATION.labels(kind="full").time():
+                self.reconcile_projfiles(is_dirty=projfiles_is_dirty)
+                self.reconcile_quotas(is_dirty=quotas_is_dirty)
+                self.save_state()
+            self.export_usage()
+
+    def export_usage(self):
+        """
+        Write the usage & limits of all home directories to usage_export_file, at most
+        once every usage_export_interval seconds.
+
+        Limits are the ones we know to be applied. Usage comes from the snapshot served
+        to metrics, which is refreshed first if it is older than usage_export_interval.
+        Entries are written one at a time, so memory use doesn't grow with the number
+        of home directories. Block values are in bytes.
+        """
+        if not self.usage_export_file or self._projects is None:
+            return
+        now = time.monotonic()
+        if (
+            self._usage_exported is not None
+            and now - self._usage_exported < self.usage_export_interval
+        ):
+            return
+
+        if not self._quota_snapshot or (
+            now - self._quota_snapshot[0] > self.usage_export_interval
+        ):
+            self._snapshot_lock.acquire()
+            self.refresh_quota_snapshot()
+            if not self._quota_snapshot:
+                return
+        _, usage = self._quota_snapshot
+        projects = self._projects
+
+        self._usage_exported = now
+        try:
+            # Applied quotas are changed by API requests while reconciling
+            with self._reconcile_lock, open_replace_atomic(self.usage_export_file) as f:
+                # Readable by the hub or a sidecar, running as another user
+                os.fchmod(f.fileno(), 0o644)
+                f.write(
+                    f'{{"version":{USAGE_EXPORT_VERSION},"timestamp":{time.time()},'
+                    '"homes":['
+                )
+                separator = ""
+                for path, record in self._applied_quotas.records():
+                    if path not in projects:
+                        # This home directory is gone
+                        continue
+                    used = usage.record(path) or record
+                    entry = {
+                        "name": os.path.basename(path),
+                        "path": path,
+                        "bytes_used": used.blocks_used * 1024,
+                        "bytes_soft_limit": record.blocks_soft * 1024,
+                        "bytes_hard_limit": record.blocks_hard * 1024,
+                        "inodes_used": used.inodes_used,
+                        "inodes_soft_limit": record.inodes_soft,
+                        "inodes_hard_limit": record.inodes_hard,
+                    }
+                    f.write(separator + json.dumps(entry, separators=(",", ":")))
+                    separator = ","
+                f.write("]}\n")
+        except OSError as e:
+            self.log.error(
+                f"Writing usage to {self.usage_export_file} failed! Continuing...",
+                exc_info=e,
             )
+
+    def reconcile_changes(self, *, added=(), removed=(), changed=()):
+        """
+        Reconcile a set of changes to home directories, without rescanning everything.
+
+        `added` and `removed` are paths of home directories that have appeared or gone
+        away, and `changed` are paths of home directories whose intended quota may have
+        changed. Only the affected projects are touched, using the state kept from the
+        last full reconciliation to decide what needs doing.
+        """
+        with self._reconcile_lock:
+            if self._projects is None:
+                # We don't have anything to work from yet
+                self.reconcile_step()
+                return
+
+            start = time.monotonic()
+            projects = dict(self._projects)
+            added = [
+                p for p in sorted(added) if p not in projects and self.is_homedir(p)
+            ]
+            removed = [
+                p for p in sorted(removed) if p in projects and not os.path.isdir(p)
+            ]
+
+            if added or removed:
+                for home in removed:
+                    del projects[home]
+                    self._applied_projects.pop(home, None)
+                    self._applied_quotas.discard(home)
+                    self._incomplete_setups.discard(home)
+                    self._deferred_setups.discard(home)
+                    self.log.debug(f"Removed project {home}")
+
+                self.update_projfiles(self.read_projfiles(), projects, added)
+                projects = self._projects
+
+            intended_quotas = {}
+            for project in [*added, *changed]:
+                if project not in projects:
+                    continue
+                intended_quota = self.intended_quota(project)
+                if self.project_is_dirty(project, projects[project], intended_quota):
+                    intended_quotas[project] = intended_quota
+
+            self.apply_quotas(projects, intended_quotas)
+            self.save_state()
+            metrics.RECONCILE_DURATION.labels(kind="incremental").observe(
+                time.monotonic() - start
+            )
+
+    def home_paths(self, name):
+        """
+        Return the paths of the home directories called `name` in any of paths
+        """
+        if not name or "/" in name:
+            return []
+        paths = [os.path.join(base, name) for base in self.paths]
+        return [path for path in paths if self.is_homedir(path)]
+
+    def home_status(self, name):
+        """
+        Return what we know about the home directory called `name`, without reading
+        anything from disk, or None if there is no such home directory.
+
+        Usage is as of the last quota report, and block values are in KiB.
+        """
+        paths = self.home_paths(name)
+        if not paths:
+            return None
+        projects = self._projects or {}
+        override = self._temporary_overrides.get(name)
+        homes = []
+        for path in paths:
+            record = self._applied_quotas.record(path)
+            homes.append(
+                {
+                    "path": path,
+                    "projid": projects.get(path),
+                    "quota": record.to_dict() if record else None,
+                    "intended": self.intended_quota(path).to_dict(),
+                    "setup_running": path in self._running_setups,
+                }
+            )
+        return {
+            "name": name,
+            "override": override[0] if override else None,
+            "homes": homes,
+        }
+
+    def reconcile_home(self, name):
+        """
+        Set up the home directory called `name` and apply its limits, right away.
+
+        Returns False if there is no such home directory.
+        """
+        paths = self.home_paths(name)
+        if not paths:
+            return False
+        self.reconcile_changes(added=paths, changed=paths)
+        return True
+
+    def set_temporary_override(self, name, limits, *, expires_in=None):
+        """
+        Override the limits of home directories called `name`, until `expires_in`
+        seconds from now or until restarted, and apply them right away.
+
+        `limits` has any of the keys of `quota_overrides` entries. Raises ValueError if
+        it is invalid, and returns False without setting it if there is no such home
+        directory.
+        """
+        if not name or "/" in name:
+            raise ValueError(f"Invalid home directory name {name!r}")
+        traits = limit_traits()
+        validated = {}
+        for key, value in limits.items():
+            if key not in traits:
+                raise ValueError(f"Unknown limit {key!r}")
+            if not is_finite(value):
+                raise ValueError(
+                    f"Limit {key!r} must be a finite number, not {value!r}"
+                )
+            if value < 0:
+                raise ValueError(f"Limit {key!r} must not be negative")
+            if isinstance(traits[key], Int) and not float(value).is_integer():
+                raise ValueError(f"Limit {key!r} must be an integer")
+            # Block limits are in GiB, and applied in KiB
+            scale = 1024 * 1024 if isinstance(traits[key], Float) else 1
+            if value * scale > MAX_VALUE:
+                raise ValueError(f"Limit {key!r} is too large")
+            validated[key] = type(traits[key].default_value)(value)
+        if expires_in is not None:
+            if not is_finite(expires_in):
+                raise ValueError(
+                    f"expires_in must be a finite number, not {expires_in!r}"
+                )
+            expires_in = time.monotonic() + expires_in
+
+        with self._reconcile_lock:
+            paths = self.home_paths(name)
+            if not paths:
+                return False
+            previous = (self._temporary_overrides, self._quota_policy)
+            self._temporary_overrides = {
+                **self._temporary_overrides,
+                name: (validated, expires_in),
+            }
+            self._quota_policy = None
             try:
-                logged_check_call(
-                    [
-                        "xfs_quota",
-                        "-x",
-                        "-c",
-                        f"limit -p bhard={intended_quotas[project]}k bsoft=0 ihard=0 isoft=0 rtbsoft=0 rtbhard=0 {project}",
-                        "-D",
-                        f"{self.projects_file}",
-                        "-P",
-                        f"{self.projid_file}",
-                        mountpoint,
-                    ],
-                    self.log,
+                # Make sure the new policy compiles before we use it
+                self.get_quota_policy()
+            except Exception as e:
+                self._temporary_overrides, self._quota_policy = previous
+                raise ValueError(f"Invalid override for {name!r}: {e}") from e
+            self.log.info(f"Set temporary override of limits for {name}: {validated}")
+            self.reconcile_changes(changed=paths)
+        return True
+
+    def clear_temporary_override(self, name):
+        """
+        Remove the temporary override for home directories called `name`, if any
+        """
+        with self._reconcile_lock:
+            if name not in self._temporary_overrides:
+                return
+            self._temporary_overrides = {
+                k: v for k, v in self._temporary_overrides.items() if k != name
+            }
+            self._quota_policy = None
+            self.log.info(f"Removed temporary override of limits for {name}")
+            self.reconcile_changes(changed=self.home_paths(name))
+
+    def expire_overrides(self, *, reconcile=True):
+        """
+        Remove temporary overrides that have expired, and restore the limits of their
+        home directories unless `reconcile` is False
+        """
+        now = time.monotonic()
+        expired = [
+            name
+            for name, (_, expires_at) in self._temporary_overrides.items()
+            if expires_at is not None and expires_at <= now
+        ]
+        if not expired:
+            return
+        with self._reconcile_lock:
+            self._temporary_overrides = {
+                k: v for k, v in self._temporary_overrides.items() if k not in expired
+            }
+            self._quota_policy = None
+            self.log.info(f"Temporary overrides for {', '.join(expired)} expired")
+            if reconcile:
+                self.reconcile_changes(
+                    changed=[path for name in expired for path in self.home_paths(name)]
                 )
-            except subprocess.CalledProcessError as e:
-                self.log.error(
-                    f"Setting up limit for {project} failed! Continuing...",
+
+    def config_stamp(self):
+        """
+        Return the inode, size & modification time of config_file and its siblings.
+
+        Kubernetes updates mounted Secrets & ConfigMaps by swapping the symlink they
+        point through, so the stat of each file (following symlinks) changes.
+        """
+        config_dir = os.path.dirname(os.path.abspath(self.config_file))
+        stamp = []
+        for name in sorted(os.listdir(config_dir)):
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(config_dir, name))
+            except OSError:
+                continue
+            stamp.append((name, st.st_ino, st.st_size, st.st_mtime_ns))
+        return tuple(stamp)
+
+    def load_file_config(self):
+        """
+        Load config_file again, returning its Config with the command line applied
+        """
+        config_dir, name = os.path.split(os.path.abspath(self.config_file))
+        loader_class = (
+            JSONFileConfigLoader if name.endswith(".json") else PyFileConfigLoader
+        )
+        config = loader_class(name, path=config_dir, log=self.log).load_config()
+        # Keep the priority of settings on the command line
+        config.merge(self.cli_config)
+        return config
+
+    def restart_changes(self, config):
+        """
+        Return the names of settings in config that differ from the ones we started
+        with, and are not reloaded without a restart
+        """
+        if self._initial_config is None:
+            return []
+        initial = self._initial_config
+        changes = []
+        for section in sorted(set(initial) | set(config)):
+            old = initial[section] if section in initial else {}
+            new = config[section] if section in config else {}
+            if not (isinstance(old, dict) and isinstance(new, dict)):
+                if old != new:
+                    changes.append(section)
+                continue
+            for name in sorted(set(old) | set(new)):
+                if section == type(self).__name__ and name in POLICY_TRAITS:
+                    continue
+                if old.get(name) != new.get(name):
+                    changes.append(f"{section}.{name}")
+        return changes
+
+    def reload_policy(self):
+        """
+        Reload the quota policy from config_file, and re-apply limits that changed.
+
+        Returns True if the policy was reloaded. If loading it fails, the current
+        policy is kept. Changes to any other settings are only logged, as they need
+        a restart.
+        """
+        try:
+            config = self.load_file_config()
+        except Exception as e:
+            # Anything can go wrong when running a Python config file
+            self.log.error("Reloading config failed! Continuing...", exc_info=e)
+            return False
+
+        restart_changes = self.restart_changes(config)
+        if restart_changes:
+            self.log.warning(
+                f"Config changes to {', '.join(restart_changes)} are not applied until "
+                "restarted"
+            )
+
+        section = config.get(type(self).__name__, {})
+        new_values = {
+            name: (section[name] if name in section else self.trait_defaults(name))
+            for name in POLICY_TRAITS
+        }
+        changed = {
+            name: value
+            for name, value in new_values.items()
+            if value != getattr(self, name)
+        }
+        if not changed:
+            self.log.info("Config changed, but the quota policy didn't")
+            return False
+
+        previous = {name: getattr(self, name) for name in changed}
+        try:
+            with self.hold_trait_notifications():
+                for name, value in changed.items():
+                    setattr(self, name, value)
+            # Make sure the new policy compiles before we use it
+            self.get_quota_policy()
+        except Exception as e:
+            self.log.error(
+                "Reloaded quota policy is invalid, keeping the current one! Continuing...",
+                exc_info=e,
+            )
+            with self.hold_trait_notifications():
+                for name, value in previous.items():
+                    setattr(self, name, value)
+            return False
+
+        self.log.info(f"Reloaded quota policy, with changes to {', '.join(changed)}")
+        if self._projects is not None:
+            # Only projects whose intended quota is not what is applied are touched
+            self.reconcile_changes(changed=self._projects)
+        return True
+
+    def check_config(self):
+        """
+        Reload the quota policy if the config files changed since we last checked
+        """
+        if not (self.reload_config and self.config_file):
+            return
+        stamp = self.config_stamp()
+        if stamp == self._config_stamp:
+            return
+        if self._config_stamp:
+            with self._reconcile_lock:
+                self.reload_policy()
+        else:
+            try:
+                self._initial_config = self.load_file_config()
+            except Exception as e:
+                self.log.warning(
+                    f"Loading {self.config_file} to watch for changes failed",
                     exc_info=e,
                 )
-                continue
+        self._config_stamp = stamp
 
-    def reconcile_step(self, *, projfiles_is_dirty=False, quotas_is_dirty=False):
-        self.reconcile_projfiles(is_dirty=projfiles_is_dirty)
-        self.reconcile_quotas(is_dirty=quotas_is_dirty)
+    def watch(self):
+        """
+        Reconcile home directories as they are created or removed in paths.
+
+        Only the changed home directories are reconciled when inotify reports them.
+        A full reconciliation is still run every `full_reconcile_interval` seconds,
+        and whenever inotify tells us it may have dropped events.
+        """
+        while True:
+            # The base paths must exist before we can watch them
+            for path in self.paths:
+                os.makedirs(path, exist_ok=True)
+
+            with DirectoryWatcher(self.paths) as watcher:
+                # Anything created before the watch was set up is caught by this run
+                self.reconcile_step()
+                next_full_reconcile = time.monotonic() + self.full_reconcile_interval
+                watch_count = len(watcher.watches)
+
+                while len(watcher.watches) == watch_count:
+                    timeout = next_full_reconcile - time.monotonic()
+                    if self.reload_config:
+                        timeout = min(timeout, self.config_check_interval)
+                    if self.usage_export_file:
+                        timeout = min(timeout, self.usage_export_interval)
+                    added, removed, rescan = watcher.wait(timeout)
+                    if rescan:
+                        self.log.warning("Lost track of inotify events, rescanning")
+                    elif added or removed:
+                        self.log.info(
+                            f"Home directories changed (added: {sorted(added)}, removed: {sorted(removed)})"
+                        )
+                        self.reconcile_changes(added=added, removed=removed)
+                    self.check_config()
+                    self.expire_overrides()
+                    self.export_usage()
+
+                    if not rescan and time.monotonic() < next_full_reconcile:
+                        continue
+
+                    self.reconcile_step()
+                    next_full_reconcile = (
+                        time.monotonic() + self.full_reconcile_interval
+                    )
+
+            # One of the base paths went away, so set up the watches again
+            self.log.warning("Watched paths changed, re-creating inotify watches")
 
     def start(self):
+        if self.enable_api and not self.api_token:
+            raise ValueError("api_token must be set to enable the API")
         if self.enable_metrics:
+            REGISTRY.register(metrics.DirectoryCollector(self))
             metrics_server, metrics_server_thread = start_http_server(self.metrics_port)
+        if self.enable_api:
+            api_server, api_server_thread = start_api_server(
+                self, self.api_ip, self.api_port, self.api_token
+            )
         try:
-            while True:
-                self.reconcile_step()
-                time.sleep(self.wait_time)
+            self.load_state()
+            self.check_config()
+            if self.use_inotify:
+                self.watch()
+            else:
+                while True:
+                    self.reconcile_step()
+                    next_reconcile = time.monotonic() + self.wait_time
+                    while time.monotonic() < next_reconcile:
+                        timeout = next_reconcile - time.monotonic()
+                        if self.reload_config:
+                            timeout = min(timeout, self.config_check_interval)
+                        time.sleep(max(timeout, 0))
+                        self.check_config()
         finally:
             if self.enable_metrics:
                 metrics_server.shutdown()
                 metrics_server_thread.join()
+            if self.enable_api:
+                api_server.shutdown()
+                api_server_thread.join()
 
 
 def main():
@@ -0,0 +1,159 @@
+"""
+Minimal inotify bindings, used to notice home directories appearing or disappearing.
+
+We only care about entries being created or removed directly inside the base paths,
+so this deliberately doesn't try to be a general purpose inotify wrapper.
+"""
+
+import ctypes
+import errno
+import os
+import os.path
+import select
+import struct
+
+# Event masks, from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class DirectoryWatcher:
+    """
+    Watch a set of base directories for subdirectories being created or removed.
+    """
+
+    def __init__(self, paths):
+        libc = _get_libc()
+        self.fd = _check(libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        # Mapping of watch descriptors to the base path they watch
+        self.watches = {}
+        try:
+            for path in paths:
+                wd = _check(
+                    libc.inotify_add_watch(
+                        self.fd, os.fsencode(path), ctypes.c_uint32(WATCH_MASK)
+                    )
+                )
+                self.watches[wd] = path
+        except BaseException:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_available(self):
+        """
+        Read all currently queued events, without blocking
+        """
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes to the watched directories.
+
+        Returns a tuple of (added, removed, rescan). `added` and `removed` are sets of
+        full paths of directories that were created or removed directly inside a watched
+        path. `rescan` is True when events may have been lost (queue overflow, or a
+        watched path itself going away), in which case callers should do a full scan.
+        """
+        added = set()
+        removed = set()
+        rescan = False
+
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return added, removed, rescan
+
+        buffer = self._read_available()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # A watched base path went away, we can't trust our view anymore
+                self.watches.pop(wd, None)
+                rescan = True
+                continue
+            # Only directories matter, files in the base paths are never homes
+            if not (mask & IN_ISDIR) or wd not in self.watches:
+                continue
+
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            # Later events win, so a directory created and removed in quick
+            # succession is only reported as removed
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                added.add(path)
+                removed.discard(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.add(path)
+                added.discard(path)
+
+        return added, removed, rescan
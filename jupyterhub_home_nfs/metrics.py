@@ -1,17 +1,163 @@
-from prometheus_client import Gauge
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
 
 NAMESPACE = "dirsize"
 
-TOTAL_SIZE = Gauge(
-    "total_size_bytes",
-    "Total Size of the Directory (in bytes)",
-    namespace=NAMESPACE,
-    labelnames=("directory",),
+
+class DirectoryCollector:
+    """
+    Collect usage & limits of home directories when metrics are scraped.
+
+    They are served from the last quotas read by the QuotaManager, see
+    QuotaManager.directory_quotas, so scrapes never wait on reading quotas.
+    """
+
+    def __init__(self, quota_manager):
+        self.quota_manager = quota_manager
+
+    def _families(self):
+        return (
+            GaugeMetricFamily(
+                f"{NAMESPACE}_total_size_bytes",
+                "Total Size of the Directory (in bytes)",
+                labels=("directory",),
+            ),
+            GaugeMetricFamily(
+                f"{NAMESPACE}_hard_limit_bytes",
+                "Hard Limit of the Directory (in bytes)",
+                labels=("directory",),
+            ),
+            GaugeMetricFamily(
+                f"{NAMESPACE}_soft_limit_bytes",
+                "Soft Limit of the Directory (in bytes, 0 for no limit)",
+                labels=("directory",),
+            ),
+            GaugeMetricFamily(
+                f"{NAMESPACE}_over_soft_limit",
+                "Whether the Directory is over its soft limit (1) or not (0)",
+                labels=("directory",),
+            ),
+            GaugeMetricFamily(
+                f"{NAMESPACE}_inodes_used",
+                "Number of inodes used in the Directory",
+                labels=("directory",),
+            ),
+            GaugeMetricFamily(
+                f"{NAMESPACE}_inodes_hard_limit",
+                "Hard Limit on the number of inodes in the Directory (0 for no limit)",
+                labels=("directory",),
+            ),
+        )
+
+    def describe(self):
+        return self._families()
+
+    def collect(self):
+        families = self._families()
+        (
+            total_size,
+            hard_limit,
+            soft_limit,
+            over_soft_limit,
+            inodes_used,
+            inodes_hard_limit,
+        ) = families
+        for directory, record in self.quota_manager.directory_quotas():
+            # xfs_quotas sets things in KB, so let's convert it to bytes
+            total_size.add_metric([directory], record.blocks_used * 1024)
+            hard_limit.add_metric([directory], record.blocks_hard * 1024)
+            soft_limit.add_metric([directory], record.blocks_soft * 1024)
+            over_soft_limit.add_metric(
+                [directory],
+                int(
+                    bool(record.blocks_soft) and record.blocks_used > record.blocks_soft
+                ),
+            )
+            inodes_used.add_metric([directory], record.inodes_used)
+            inodes_hard_limit.add_metric([directory], record.inodes_hard)
+        return list(families)
+
+
+# Metrics about the quota manager itself, rather than the directories it manages
+MANAGER_NAMESPACE = "jupyterhub_home_nfs"
+
+# Reconciling can take anywhere from milliseconds to hours on large filesystems
+DURATION_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    60,
+    300,
+    900,
+    3600,
+    float("inf"),
+)
+
+RECONCILE_DURATION = Histogram(
+    "reconcile_duration_seconds",
+    "Time taken by a reconciliation run, full or incremental",
+    namespace=MANAGER_NAMESPACE,
+    labelnames=("kind",),
+    buckets=DURATION_BUCKETS,
+)
+
+PHASE_DURATION = Histogram(
+    "reconcile_phase_duration_seconds",
+    "Time taken by each phase of reconciliation "
+    "(scan, projid_parse, report, project_read, apply)",
+    namespace=MANAGER_NAMESPACE,
+    labelnames=("phase",),
+    buckets=DURATION_BUCKETS,
+)
+
+SUBPROCESS_CALLS = Counter(
+    "subprocess_calls",
+    "Number of subprocesses run",
+    namespace=MANAGER_NAMESPACE,
+    labelnames=("command",),
+)
+
+SUBPROCESS_FAILURES = Counter(
+    "subprocess_failures",
+    "Number of subprocesses that exited with a non-zero status",
+    namespace=MANAGER_NAMESPACE,
+    labelnames=("command",),
+)
+
+MANAGED_PROJECTS = Gauge(
+    "managed_projects",
+    "Number of home directories with a project ID",
+    namespace=MANAGER_NAMESPACE,
+)
+
+DIRTY_PROJECTS = Gauge(
+    "dirty_projects",
+    "Number of projects that needed their quota applied in the last reconciliation",
+    namespace=MANAGER_NAMESPACE,
+)
+
+SETUP_BACKLOG = Gauge(
+    "setup_backlog",
+    "Number of project setups running or deferred to the next run",
+    namespace=MANAGER_NAMESPACE,
+)
+
+SETUP_DURATION = Histogram(
+    "project_setup_duration_seconds",
+    "Time taken by project setups walking a home directory, by result "
+    "(success, failure)",
+    namespace=MANAGER_NAMESPACE,
+    labelnames=("result",),
+    buckets=DURATION_BUCKETS,
 )
 
-HARD_LIMIT = Gauge(
-    "hard_limit_bytes",
-    "Hard Limit of the Directory (in bytes)",
-    namespace=NAMESPACE,
-    labelnames=("directory",),
+SETUP_THROTTLE = Counter(
+    "project_setup_throttle_seconds",
+    "Time project setups waited for the setup_files_per_second budget",
+    namespace=MANAGER_NAMESPACE,
 )
@@ -0,0 +1,154 @@
+"""
+Decide which limits apply to which home directory.
+
+Limits come from, in order of priority: exact `quota_overrides`, exact `exclude`
+entries, the first matching of the `quota_rules` and finally the defaults. Rules are
+compiled once, and the result for each directory name is cached, so evaluating the
+policy stays cheap with many homes and many rules.
+"""
+
+import fnmatch
+import re
+
+from traitlets import Bool, Float, Int, Unicode
+
+from .quotas import QuotaRecord
+
+
+def limit_traits():
+    """
+    Return traits of the limits that overrides, tiers and rules can set
+    """
+    return {
+        "hard_quota": Float(),
+        "soft_quota": Float(),
+        "inode_hard_quota": Int(),
+        "inode_soft_quota": Int(),
+    }
+
+
+def rule_traits():
+    """
+    Return traits of the keys a rule in `quota_rules` can have
+    """
+    return {
+        "pattern": Unicode(),
+        "regex": Unicode(),
+        "tier": Unicode(),
+        "exclude": Bool(),
+        **limit_traits(),
+    }
+
+
+def check_keys(what, value, allowed):
+    """
+    Raise ValueError if the dict `value` has keys that aren't in `allowed`
+    """
+    unknown = sorted(set(value) - set(allowed))
+    if unknown:
+        raise ValueError(
+            f"{what} has unknown keys {', '.join(map(repr, unknown))}: {value}"
+        )
+
+
+def limits_to_record(limits):
+    """
+    Convert a dict of limits (with block limits in GiB) to a QuotaRecord
+    """
+    return QuotaRecord(
+        # Convert GiB to KiB for xfs_quota
+        blocks_hard=int(limits["hard_quota"] * 1024 * 1024),
+        blocks_soft=int(limits["soft_quota"] * 1024 * 1024),
+        inodes_hard=limits["inode_hard_quota"],
+        inodes_soft=limits["inode_soft_quota"],
+    )
+
+
+class QuotaPolicy:
+    """
+    Compiled quota policy, mapping home directory names to the limits to set on them.
+
+    `defaults` is a dict with all the keys of `limit_traits()`. `overrides` maps
+    directory names to either a hard quota (in GiB) or a dict overriding some of the
+    defaults, and directories in `exclude` get no limits at all. `rules` is a list of
+    dicts with either a glob `pattern` or a `regex` that must match the whole directory
+    name, and the limits to apply: those of a named `tier` from `tiers`, any limits
+    given in the rule itself, or none at all with `exclude`.
+
+    Raises ValueError if an override, tier or rule is invalid.
+    """
+
+    def __init__(self, defaults, *, overrides=None, exclude=(), rules=(), tiers=None):
+        tiers = tiers or {}
+        for name, tier in tiers.items():
+            check_keys(f"Quota tier {name!r}", tier, limit_traits())
+        self._defaults = limits_to_record(defaults)
+
+        self._overrides = {}
+        for name, override in (overrides or {}).items():
+            if isinstance(override, dict):
+                check_keys(f"Quota override for {name!r}", override, limit_traits())
+                self._overrides[name] = limits_to_record({**defaults, **override})
+            else:
+                self._overrides[name] = limits_to_record(
+                    {**defaults, "hard_quota": override}
+                )
+        self._exclude = frozenset(exclude)
+
+        # List of (compiled regex, limits) of each rule, in order
+        self._rules = []
+        for i, rule in enumerate(rules):
+            check_keys(f"Quota rule {i}", rule, rule_traits())
+            if ("pattern" in rule) == ("regex" in rule):
+                raise ValueError(
+                    f"Quota rule {i} must have exactly one of 'pattern' or 'regex': {rule}"
+                )
+            if "pattern" in rule:
+                regex = re.compile(fnmatch.translate(rule["pattern"]))
+            else:
+                # Compiled on its own, so inline flags and backreferences work as
+                # they would in any other regex
+                try:
+                    regex = re.compile(rule["regex"])
+                except re.error as e:
+                    raise ValueError(f"Quota rule {i} has an invalid regex: {e}")
+
+            if rule.get("exclude"):
+                limits = QuotaRecord()
+            else:
+                tier = {}
+                if "tier" in rule:
+                    if rule["tier"] not in tiers:
+                        raise ValueError(
+                            f"Quota rule {i} uses unknown tier {rule['tier']!r}"
+                        )
+                    tier = tiers[rule["tier"]]
+                inline = {k: v for k, v in rule.items() if k in defaults}
+                limits = limits_to_record({**defaults, **tier, **inline})
+
+            self._rules.append((regex, limits))
+
+        # Mapping of directory names to their limits, as evaluated so far
+        self._cache = {}
+
+    def intended_quota(self, name):
+        """
+        Return the limits for the home directory called `name`, as a QuotaRecord
+        """
+        limits = self._cache.get(name)
+        if limits is None:
+            limits = self._cache[name] = self._evaluate(name)
+        return limits
+
+    def _evaluate(self, name):
+        # Set quotas based on priority: quota_overrides > exclude > rules > defaults
+        if name in self._overrides:
+            return self._overrides[name]
+        if name in self._exclude:
+            # Exclude means no limits at all
+            return QuotaRecord()
+        # The first matching rule wins
+        for regex, limits in self._rules:
+            if regex.fullmatch(name):
+                return limits
+        return self._defaults
@@ -0,0 +1,148 @@
+"""
+Compact storage for the quotas of many projects.
+"""
+
+from array import array
+from collections.abc import Mapping
+from typing import NamedTuple
+
+GROUPS = ("blocks", "inodes", "realtime")
+KINDS = ("used", "soft", "hard")
+# Largest value a QuotaTable holds, as quotas are 64-bit on disk too
+MAX_VALUE = 2**63 - 1
+
+
+class QuotaRecord(NamedTuple):
+    """
+    Quotas of a single project. Block values are in KiB.
+    """
+
+    blocks_used: int = 0
+    blocks_soft: int = 0
+    blocks_hard: int = 0
+    inodes_used: int = 0
+    inodes_soft: int = 0
+    inodes_hard: int = 0
+    realtime_used: int = 0
+    realtime_soft: int = 0
+    realtime_hard: int = 0
+
+    def to_dict(self):
+        """
+        Return the quotas as `{"blocks": {"used": ..., "soft": ..., "hard": ...}, ...}`
+        """
+        values = iter(self)
+        return {group: {kind: next(values) for kind in KINDS} for group in GROUPS}
+
+    def limits(self):
+        """
+        Return the soft & hard limits of every group, leaving out usage
+        """
+        return tuple(
+            value
+            for field, value in zip(self._fields, self)
+            if not field.endswith("_used")
+        )
+
+    @classmethod
+    def from_limits(cls, limits):
+        """
+        Create a record from the values returned by `limits()`, with no usage
+        """
+        fields = [field for field in cls._fields if not field.endswith("_used")]
+        return cls(**dict(zip(fields, limits)))
+
+
+class QuotaTable(Mapping):
+    """
+    Quotas for many projects, keyed by project path.
+
+    Values are kept in one array of integers per field, indexed by the row of each
+    project, rather than in nested dicts per project. Looking a project up with
+    `table[path]` builds the nested dict structure (see `QuotaRecord.to_dict`) on
+    demand, while `record()` and `records()` give cheaper access.
+    """
+
+    __slots__ = ("_rows", "_paths", "_columns")
+
+    def __init__(self):
+        # Mapping of project paths to their row
+        self._rows = {}
+        self._paths = []
+        self._columns = tuple(array("q") for _ in QuotaRecord._fields)
+
+    def set(self, path, record):
+        """
+        Set the quotas of the project at path to a QuotaRecord
+        """
+        row = self._rows.get(path)
+        if row is None:
+            self._rows[path] = len(self._paths)
+            self._paths.append(path)
+            for column, value in zip(self._columns, record):
+                column.append(value)
+        else:
+            for column, value in zip(self._columns, record):
+                column[row] = value
+
+    def copy(self):
+        """
+        Return a copy of the table, which can be changed independently
+        """
+        table = type(self)()
+        table._rows = dict(self._rows)
+        table._paths = list(self._paths)
+        table._columns = tuple(array("q", column) for column in self._columns)
+        return table
+
+    def discard(self, path):
+        """
+        Remove the project at path, if present
+        """
+        row = self._rows.pop(path, None)
+        if row is None:
+            return
+        # Move the last row into the gap, so removal doesn't shift every row after it
+        last_path = self._paths.pop()
+        for column in self._columns:
+            last_value = column.pop()
+            if last_path != path:
+                column[row] = last_value
+        if last_path != path:
+            self._paths[row] = last_path
+            self._rows[last_path] = row
+
+    def record(self, path):
+        """
+        Return the QuotaRecord for the project at path, or None
+        """
+        row = self._rows.get(path)
+        if row is None:
+            return None
+        return QuotaRecord._make(column[row] for column in self._columns)
+
+    def records(self):
+        """
+        Iterate over (path, QuotaRecord) for all projects
+        """
+        for row, path in enumerate(self._paths):
+            yield path, QuotaRecord._make(column[row] for column in self._columns)
+
+    def __getitem__(self, path):
+        record = self.record(path)
+        if record is None:
+            raise KeyError(path)
+        return record.to_dict()
+
+    def __contains__(self, path):
+        return path in self._rows
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __repr__(self):
+        records = ", ".join(f"{path!r}: {record}" for path, record in self.records())
+        return f"{type(self).__name__}({{{records}}})"
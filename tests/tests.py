@@ -1,14 +1,33 @@
+import asyncio
+import json
+import logging
 import os
 import subprocess
 import tempfile
 import textwrap
+import threading
+import time
 from pprint import pprint  # noqa: F401
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import pytest
+from prometheus_client import REGISTRY
 from prometheus_client.core import Sample
 
 from jupyterhub_home_nfs import metrics
+from jupyterhub_home_nfs.api import start_api_server
+from jupyterhub_home_nfs.backends import (
+    FakeQuotaBackend,
+    QuotactlBackend,
+    XfsQuotaBackend,
+    async_logged_check_call,
+    iter_check_call,
+    logged_check_call,
+)
 from jupyterhub_home_nfs.generate import OWNERSHIP_PREAMBLE, QuotaManager
+from jupyterhub_home_nfs.inotify import DirectoryWatcher
+from jupyterhub_home_nfs.quotas import QuotaRecord, QuotaTable
 
 MOUNT_POINT = "/mnt/docker-test-xfs"
 
@@ -73,12 +92,48 @@ def quota_manager(tmp_path):
     yield quota_manager
 
 
+@pytest.fixture
+def fake_quota_manager(quota_manager, tmp_path):
+    """
+    quota_manager with the in-memory FakeQuotaBackend, managing the home directories
+    in a temporary directory, `fake_quota_manager.paths[0]`
+    """
+    base = tmp_path / "homes"
+    base.mkdir()
+    quota_manager.paths = [os.fspath(base)]
+    quota_manager.quota_backend_class = FakeQuotaBackend
+    yield quota_manager
+
+
+def record_setups(monkeypatch, backend):
+    """
+    Return a list of the projects backend sets up from now on, in order
+    """
+    setups = []
+    setup_project = backend.setup_project
+    monkeypatch.setattr(
+        backend,
+        "setup_project",
+        lambda mountpoint, project: setups.append(project)
+        or setup_project(mountpoint, project),
+    )
+    return setups
+
+
 def create_home_directories(base_dir, homedirs):
     # create the homedirs
     for d in homedirs:
         os.mkdir(os.path.join(base_dir, d))
 
 
+def collect_directory_metrics(quota_manager):
+    """
+    Return a mapping of metric names to metric families served for directories
+    """
+    collector = metrics.DirectoryCollector(quota_manager)
+    return {family.name: family for family in collector.collect()}
+
+
 def test_reconcile_projids(quota_manager):
     # Loop over homedirs inside this test function, as we're testing statefulness
     for homedirs in [
@@ -120,6 +175,118 @@ def test_reconcile_projids(quota_manager):
         assert projects_contents == expected_projects_contents
 
 
+def test_reuse_projids(quota_manager):
+    """Test that project IDs of removed home directories are handed out again"""
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.reuse_projids = True
+    for homedirs in [
+        {"a": 1001, "b": 1002, "c": 1003, "d": 1004},
+        # 'b' and 'c' are removed, and their IDs reused lowest first
+        {"a": 1001, "d": 1004, "e": 1002, "f": 1003, "g": 1005},
+    ]:
+        clear_home_directories(MOUNT_POINT)
+        create_home_directories(MOUNT_POINT, homedirs)
+        quota_manager.reconcile_projfiles()
+
+        assert quota_manager.parse_projids(quota_manager.projid_file) == {
+            os.path.join(MOUNT_POINT, k): v for k, v in homedirs.items()
+        }
+
+
+def test_projid_high_water_mark(quota_manager, tmp_path):
+    """Test that the highest project ID isn't handed out again once removed"""
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.state_file = os.fspath(tmp_path / "state.json")
+    for homedirs in [
+        {"a": 1001, "b": 1002},
+        # 'b' is removed, in a pass of its own
+        {"a": 1001},
+        {"a": 1001, "c": 1003},
+    ]:
+        clear_home_directories(MOUNT_POINT)
+        create_home_directories(MOUNT_POINT, homedirs)
+        quota_manager.reconcile_projfiles()
+        quota_manager.save_state()
+
+        assert quota_manager.parse_projids(quota_manager.projid_file) == {
+            os.path.join(MOUNT_POINT, k): v for k, v in homedirs.items()
+        }
+
+    # The mark survives a restart
+    os.rmdir(os.path.join(MOUNT_POINT, "c"))
+    quota_manager.reconcile_projfiles()
+    quota_manager.save_state()
+    QuotaManager.clear_instance()
+    restarted = QuotaManager.instance(
+        paths=[MOUNT_POINT],
+        projid_file=quota_manager.projid_file,
+        projects_file=quota_manager.projects_file,
+        state_file=quota_manager.state_file,
+        min_projid=1000,
+    )
+    assert restarted.load_state()
+    create_home_directories(MOUNT_POINT, ["d"])
+    restarted.reconcile_projfiles()
+    assert restarted.parse_projids(restarted.projid_file) == {
+        os.path.join(MOUNT_POINT, "a"): 1001,
+        os.path.join(MOUNT_POINT, "d"): 1004,
+    }
+
+
+def test_append_projfiles(quota_manager, monkeypatch):
+    """Test that new entries are appended, and stale ones compacted past a threshold"""
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.append_projfiles = True
+    quota_manager.projfiles_compaction_threshold = 1
+
+    def projid_entries():
+        with open(quota_manager.projid_file) as f:
+            return [line.strip() for line in f if not line.startswith("#")]
+
+    def home(name):
+        return os.path.join(MOUNT_POINT, name)
+
+    create_home_directories(MOUNT_POINT, ["a", "b"])
+    quota_manager.reconcile_projfiles()
+    inode = os.stat(quota_manager.projid_file).st_ino
+
+    # New entries are appended in place
+    create_home_directories(MOUNT_POINT, ["c"])
+    quota_manager.reconcile_projfiles()
+    assert projid_entries() == [
+        f"{home('a')}:1001",
+        f"{home('b')}:1002",
+        f"{home('c')}:1003",
+    ]
+    assert os.stat(quota_manager.projid_file).st_ino == inode
+
+    # Nothing changed, so the projid file isn't parsed again
+    monkeypatch.setattr(quota_manager, "parse_projids", None)
+    quota_manager.reconcile_projfiles()
+    monkeypatch.undo()
+
+    # A single stale entry is left in place
+    os.rmdir(home("a"))
+    quota_manager.reconcile_projfiles()
+    assert len(projid_entries()) == 3
+    assert quota_manager._projects == {home("b"): 1002, home("c"): 1003}
+
+    # Coming back gives 'a' a new ID, which needs a rewrite
+    create_home_directories(MOUNT_POINT, ["a"])
+    quota_manager.reconcile_projfiles()
+    assert projid_entries() == [
+        f"{home('b')}:1002",
+        f"{home('c')}:1003",
+        f"{home('a')}:1004",
+    ]
+
+    # Past the threshold, stale entries are compacted
+    os.rmdir(home("a"))
+    os.rmdir(home("b"))
+    quota_manager.reconcile_projfiles()
+    assert projid_entries() == [f"{home('c')}:1003"]
+
+
 def test_missing_base_directory(quota_manager, tmp_path):
     """
     Test that reconcile_projfiles creates missing base directories
@@ -427,7 +594,9 @@ def test_metrics(quota_manager):
     quotas = quota_manager.get_applied_quotas()
     quota_manager.update_metrics(quotas)
 
-    collected_dirsize_metric = list(metrics.TOTAL_SIZE.collect())[0]
+    collected_dirsize_metric, collected_hardlimit_metric, *_ = (
+        metrics.DirectoryCollector(quota_manager).collect()
+    )
 
     assert len(collected_dirsize_metric.samples) != 0
     assert (
@@ -439,7 +608,6 @@ def test_metrics(quota_manager):
         in collected_dirsize_metric.samples
     )
 
-    collected_hardlimit_metric = list(metrics.HARD_LIMIT.collect())[0]
     assert (
         Sample(
             name="dirsize_hard_limit_bytes",
@@ -453,6 +621,378 @@ def test_metrics(quota_manager):
     )
 
 
+def test_inode_quotas(quota_manager):
+    """Test that inode limits are applied, overridden, and exported as metrics"""
+    homedirs = {"regular": 1001, "override": 1002}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1
+    quota_manager.inode_hard_quota = 1000
+    quota_manager.inode_soft_quota = 800
+    quota_manager.quota_overrides = {
+        "override": {"hard_quota": 2, "inode_hard_quota": 50},
+    }
+    quota_manager.reconcile_step()
+
+    applied_quotas = quota_manager.get_applied_quotas()
+    assert applied_quotas[os.path.join(MOUNT_POINT, "regular")] == {
+        "blocks": {"used": 0, "soft": 0, "hard": GIB_TO_KIB},
+        "inodes": {"used": 1, "soft": 800, "hard": 1000},
+        "realtime": {"used": 0, "soft": 0, "hard": 0},
+    }
+    assert applied_quotas[os.path.join(MOUNT_POINT, "override")] == {
+        "blocks": {"used": 0, "soft": 0, "hard": 2 * GIB_TO_KIB},
+        "inodes": {"used": 1, "soft": 800, "hard": 50},
+        "realtime": {"used": 0, "soft": 0, "hard": 0},
+    }
+
+    # Applied limits match the intended ones, so nothing is dirty anymore
+    quota_manager.reconcile_quotas()
+    assert REGISTRY.get_sample_value("jupyterhub_home_nfs_dirty_projects") == 0
+
+    collected = collect_directory_metrics(quota_manager)
+    assert (
+        Sample(
+            name="dirsize_inodes_hard_limit",
+            labels={"directory": "override"},
+            value=50,
+        )
+        in collected["dirsize_inodes_hard_limit"].samples
+    )
+    assert (
+        Sample(name="dirsize_inodes_used", labels={"directory": "regular"}, value=1)
+        in collected["dirsize_inodes_used"].samples
+    )
+
+
+def test_soft_quotas(quota_manager):
+    """Test that soft limits and their grace period are applied and reported"""
+    homedirs = {"regular": 1001, "bursty": 1002}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 2
+    quota_manager.soft_quota = 1
+    quota_manager.soft_quota_grace_period = 3600
+    quota_manager.quota_overrides = {"bursty": {"hard_quota": 4, "soft_quota": 2}}
+
+    def timer_calls():
+        return (
+            REGISTRY.get_sample_value(
+                "jupyterhub_home_nfs_subprocess_calls_total",
+                {"command": "xfs_quota timer"},
+            )
+            or 0
+        )
+
+    calls = timer_calls()
+    quota_manager.reconcile_step()
+    # The grace period is only set once
+    quota_manager.reconcile_step()
+    assert timer_calls() == calls + 1
+
+    applied_quotas = quota_manager.get_applied_quotas()
+    assert applied_quotas[os.path.join(MOUNT_POINT, "regular")]["blocks"] == {
+        "used": 0,
+        "soft": GIB_TO_KIB,
+        "hard": 2 * GIB_TO_KIB,
+    }
+    assert applied_quotas[os.path.join(MOUNT_POINT, "bursty")]["blocks"] == {
+        "used": 0,
+        "soft": 2 * GIB_TO_KIB,
+        "hard": 4 * GIB_TO_KIB,
+    }
+
+    # Pretend bursty went over its soft limit
+    bursty = os.path.join(MOUNT_POINT, "bursty")
+    applied_quotas.set(
+        bursty,
+        applied_quotas.record(bursty)._replace(blocks_used=3 * GIB_TO_KIB),
+    )
+    quota_manager.update_metrics(applied_quotas)
+    over_soft_limit = collect_directory_metrics(quota_manager)[
+        "dirsize_over_soft_limit"
+    ]
+    assert sorted(
+        (sample.labels["directory"], sample.value) for sample in over_soft_limit.samples
+    ) == [("bursty", 1), ("regular", 0)]
+
+
+def test_parse_report_grace_times():
+    """Test that grace times with spaces in xfs_quota reports are parsed"""
+    report = textwrap.dedent("""
+        /export/a 2048 1024 4096 00 [6 days] 3 0 0 00 [--------] 0 0 0 00 [--------]
+        /export/b 0 1024 4096 00 [--------] 1 0 0 00 [--------] 0 0 0 00 [--------]
+        """)
+    quotas = XfsQuotaBackend().parse_report(report)
+    assert quotas["/export/a"] == {
+        "blocks": {"used": 2048, "soft": 1024, "hard": 4096},
+        "inodes": {"used": 3, "soft": 0, "hard": 0},
+        "realtime": {"used": 0, "soft": 0, "hard": 0},
+    }
+    assert quotas.record("/export/b").blocks_used == 0
+
+
+def test_quota_rules(quota_manager):
+    """Test that quota rules and tiers are applied in priority order"""
+    quota_manager.hard_quota = 1
+    quota_manager.quota_tiers = {
+        "instructor": {"hard_quota": 50, "inode_hard_quota": 1_000_000},
+        "ta": {"hard_quota": 20},
+    }
+    quota_manager.quota_rules = [
+        {"pattern": "instructor-*", "tier": "instructor"},
+        {"regex": r"ta-\d+", "tier": "ta"},
+        {"pattern": "ta-*", "hard_quota": 5},
+        {"pattern": "shared-*", "exclude": True},
+    ]
+    quota_manager.quota_overrides = {"instructor-special": 100}
+    quota_manager.exclude = ["ta-0"]
+
+    def intended_quota(name):
+        intended = quota_manager.intended_quota(os.path.join(MOUNT_POINT, name))
+        return intended.blocks_hard // GIB_TO_KIB, intended.inodes_hard
+
+    assert intended_quota("student") == (1, 0)
+    assert intended_quota("instructor-alice") == (50, 1_000_000)
+    # Overrides and exclude take priority over rules
+    assert intended_quota("instructor-special") == (100, 0)
+    assert intended_quota("ta-0") == (0, 0)
+    # The first matching rule wins, and regexes must match the whole name
+    assert intended_quota("ta-1") == (20, 0)
+    assert intended_quota("ta-bob") == (5, 0)
+    assert intended_quota("shared-data") == (0, 0)
+    assert intended_quota("my-shared-data") == (1, 0)
+
+    # Changing the policy recompiles it
+    quota_manager.quota_tiers = {**quota_manager.quota_tiers, "ta": {"hard_quota": 30}}
+    assert intended_quota("ta-1") == (30, 0)
+
+    # Each regex is compiled on its own, so inline flags and backreferences work
+    quota_manager.quota_rules = [
+        {"regex": r"(\w)\1-.*", "hard_quota": 2},
+        {"regex": "(?i)inst-.*", "hard_quota": 3},
+    ]
+    assert intended_quota("aa-alice") == (2, 0)
+    assert intended_quota("ab-alice") == (1, 0)
+    assert intended_quota("INST-bob") == (3, 0)
+
+    quota_manager.quota_rules = [{"pattern": "x-*", "tier": "missing"}]
+    with pytest.raises(ValueError, match="unknown tier"):
+        intended_quota("x-1")
+    quota_manager.quota_rules = [{"regex": "(", "hard_quota": 2}]
+    with pytest.raises(ValueError, match="invalid regex"):
+        intended_quota("x-1")
+
+    # Typos in keys are errors, instead of silently falling back to the defaults
+    quota_manager.quota_rules = [{"pattern": "x-*", "hardquota": 2}]
+    with pytest.raises(ValueError, match="unknown keys 'hardquota'"):
+        intended_quota("x-1")
+    quota_manager.quota_rules = []
+    quota_manager.quota_overrides = {"alice": {"hardquota": 50}}
+    with pytest.raises(ValueError, match="unknown keys"):
+        intended_quota("alice")
+    quota_manager.quota_overrides = {}
+    quota_manager.quota_tiers = {"ta": {"inode_quota": 10}}
+    with pytest.raises(ValueError, match="unknown keys"):
+        intended_quota("alice")
+
+
+def test_reload_config(quota_manager, tmp_path, monkeypatch):
+    """Test that policy changes in the config file are applied without a restart"""
+    create_home_directories(MOUNT_POINT, ["alpha", "beta"])
+    config_file = tmp_path / "config.py"
+    config_file.write_text("c.QuotaManager.hard_quota = 1\n")
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1
+    quota_manager.config_file = os.fspath(config_file)
+    quota_manager.reload_config = True
+    quota_manager.reconcile_step()
+    quota_manager.check_config()
+
+    limits = []
+    monkeypatch.setattr(
+        quota_manager.quota_backend,
+        "set_limits",
+        lambda mountpoint, batch: limits.extend(batch) or [p for p, _, _ in batch],
+    )
+    warnings = []
+    monkeypatch.setattr(quota_manager.log, "warning", warnings.append)
+    # Nothing changed, so nothing is reloaded
+    assert not quota_manager.reload_policy()
+
+    config_file.write_text(
+        "c.QuotaManager.hard_quota = 1\n"
+        "c.QuotaManager.quota_overrides = {'beta': 3}\n"
+        "c.QuotaManager.paths = ['/elsewhere']\n"
+    )
+    quota_manager.check_config()
+    assert quota_manager.quota_overrides == {"beta": 3}
+    # Only policy traits are reloaded, and other changes are logged
+    assert quota_manager.paths == [MOUNT_POINT]
+    assert warnings == [
+        "Config changes to QuotaManager.paths are not applied until restarted"
+    ]
+    # Only the project whose quota changed gets new limits
+    assert [(project, record.blocks_hard) for project, _, record in limits] == [
+        (os.path.join(MOUNT_POINT, "beta"), 3 * GIB_TO_KIB)
+    ]
+
+    # An invalid policy is not applied
+    config_file.write_text(
+        "c.QuotaManager.hard_quota = 1\n"
+        "c.QuotaManager.quota_rules = [{'pattern': 'x-*', 'tier': 'missing'}]\n"
+    )
+    quota_manager.check_config()
+    assert quota_manager.quota_overrides == {"beta": 3}
+    assert quota_manager.quota_rules == []
+
+    # Unexpected errors compiling the policy don't stop the daemon either
+    def get_quota_policy():
+        raise RuntimeError("unexpected")
+
+    config_file.write_text("c.QuotaManager.hard_quota = 2\n")
+    monkeypatch.setattr(quota_manager, "get_quota_policy", get_quota_policy)
+    quota_manager.check_config()
+    assert quota_manager.hard_quota == 1
+    assert quota_manager.quota_overrides == {"beta": 3}
+
+
+def test_api(quota_manager):
+    """Test querying, reconciling and overriding a single home through the API"""
+    create_home_directories(MOUNT_POINT, ["alpha"])
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1
+    quota_manager.reconcile_step()
+
+    server, thread = start_api_server(quota_manager, "127.0.0.1", 0, "secret")
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/api/homes"
+
+    def api(method, path, body=None, token="secret"):
+        request = Request(
+            base_url + path,
+            method=method,
+            data=None if body is None else json.dumps(body).encode(),
+            headers={"Authorization": f"token {token}"},
+        )
+        try:
+            with urlopen(request) as response:
+                return response.status, json.load(response)
+        except HTTPError as e:
+            return e.code, json.load(e)
+
+    def hard_limit(status):
+        return status["homes"][0]["quota"]["blocks"]["hard"] // GIB_TO_KIB
+
+    try:
+        assert api("GET", "/alpha", token="wrong")[0] == 401
+        assert api("GET", "/missing")[0] == 404
+
+        status, alpha = api("GET", "/alpha")
+        assert status == 200
+        assert hard_limit(alpha) == 1
+
+        # A new home is set up right away, without waiting for the next run
+        create_home_directories(MOUNT_POINT, ["beta"])
+        status, beta = api("POST", "/beta/reconcile")
+        assert status == 200
+        assert beta["homes"][0]["projid"] is not None
+        assert hard_limit(beta) == 1
+
+        assert api("PUT", "/alpha/override", {"hard_quota": "big"})[0] == 400
+        # Sent as Infinity, which JSON parsers accept
+        assert api("PUT", "/alpha/override", {"hard_quota": float("inf")})[0] == 400
+        assert api("PUT", "/alpha/override", {"hard_quota": 1e30})[0] == 400
+        assert api("PUT", "/alpha/override", {"expires_in": float("nan")})[0] == 400
+        assert api("PUT", "/missing/override", {"hard_quota": 5})[0] == 404
+        assert quota_manager._temporary_overrides == {}
+        quota_manager.reconcile_step()
+
+        status, alpha = api("PUT", "/alpha/override", {"hard_quota": 5})
+        assert status == 200
+        assert alpha["override"] == {"hard_quota": 5.0}
+        assert hard_limit(alpha) == 5
+
+        # Expired overrides are dropped on the next run
+        api("PUT", "/alpha/override", {"hard_quota": 7, "expires_in": 0})
+        quota_manager.reconcile_step()
+        status, alpha = api("GET", "/alpha")
+        assert alpha["override"] is None
+        assert hard_limit(alpha) == 1
+
+        api("PUT", "/alpha/override", {"hard_quota": 5})
+        status, alpha = api("DELETE", "/alpha/override")
+        assert status == 200
+        assert hard_limit(alpha) == 1
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def test_reconcile_home_during_setup(fake_quota_manager, monkeypatch):
+    """Test that reconciling a home isn't held up by the setup of another one"""
+    quota_manager = fake_quota_manager
+    base = quota_manager.paths[0]
+    create_home_directories(base, ["big"])
+    big, small = os.path.join(base, "big"), os.path.join(base, "small")
+    backend = quota_manager.quota_backend
+
+    walked = threading.Event()
+    setup_project = backend.setup_project
+
+    def slow_setup_project(mountpoint, project):
+        if project == big:
+            walked.wait(10)
+        setup_project(mountpoint, project)
+
+    monkeypatch.setattr(backend, "setup_project", slow_setup_project)
+    thread = threading.Thread(target=quota_manager.reconcile_step)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while big not in quota_manager._running_setups:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        create_home_directories(base, ["small"])
+        start = time.monotonic()
+        assert quota_manager.reconcile_home("small")
+        assert time.monotonic() - start < 5
+        assert not walked.is_set()
+        assert small in quota_manager.get_applied_projects()
+    finally:
+        walked.set()
+        thread.join(10)
+    assert big in quota_manager.get_applied_projects()
+
+
+def test_usage_export(quota_manager, tmp_path):
+    """Test that usage & limits of all homes are exported as JSON"""
+    create_home_directories(MOUNT_POINT, ["alpha", "beta"])
+    export_file = tmp_path / "usage.json"
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1
+    quota_manager.quota_overrides = {"beta": 2}
+    quota_manager.usage_export_file = os.fspath(export_file)
+    quota_manager.reconcile_step()
+
+    usage = json.loads(export_file.read_text())
+    assert usage["version"] == 1
+    homes = {home["name"]: home for home in usage["homes"]}
+    assert sorted(homes) == ["alpha", "beta"]
+    assert homes["alpha"]["path"] == os.path.join(MOUNT_POINT, "alpha")
+    assert homes["alpha"]["bytes_hard_limit"] == 1024**3
+    assert homes["beta"]["bytes_hard_limit"] == 2 * 1024**3
+    assert "inodes_used" in homes["alpha"]
+
+    # Not rewritten until usage_export_interval has passed
+    inode = export_file.stat().st_ino
+    quota_manager.reconcile_step()
+    assert export_file.stat().st_ino == inode
+
+
 def test_quota_overrides_cli(tmp_path):
     """Test that quota overrides can be set via CLI"""
     # Test CLI override (traitlets supports dict parsing from CLI)
@@ -496,6 +1036,57 @@ def test_quota_overrides_cli(tmp_path):
     }, "Expected quota of 0.002 GiB for 'test'"
 
 
+def test_metrics_snapshot(quota_manager, monkeypatch):
+    """Test that metrics are served from a snapshot, refreshed in the background"""
+    create_home_directories(MOUNT_POINT, {"user": 1001, "gone": 1002})
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.metrics_max_age = 60
+    quota_manager.reconcile_step()
+    collector = metrics.DirectoryCollector(quota_manager)
+
+    def directories():
+        total_size, *_ = collector.collect()
+        return sorted(sample.labels["directory"] for sample in total_size.samples)
+
+    assert directories() == ["gone", "user"]
+
+    # Homes removed since the last run are dropped after the next refresh
+    os.rmdir(os.path.join(MOUNT_POINT, "gone"))
+    assert directories() == ["gone", "user"]
+    quota_manager.metrics_max_age = 0
+    directories()
+    # Wait for the refresh started by the scrape to finish
+    with quota_manager._snapshot_lock:
+        assert directories() == ["user"]
+
+
+def test_reconcile_metrics(quota_manager):
+    """Test that reconciliation runs are instrumented"""
+    create_home_directories(MOUNT_POINT, {"user": 1001})
+    quota_manager.paths = [MOUNT_POINT]
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(f"jupyterhub_home_nfs_{name}", labels) or 0
+
+    # There is no projid file to parse yet
+    phases = ["scan", "report", "project_read", "apply"]
+    before = {
+        phase: sample("reconcile_phase_duration_seconds_count", phase=phase)
+        for phase in phases
+    }
+    reports = sample("subprocess_calls_total", command="xfs_quota report")
+
+    quota_manager.reconcile_step()
+
+    for phase in phases:
+        assert sample("reconcile_phase_duration_seconds_count", phase=phase) > (
+            before[phase]
+        )
+    assert sample("subprocess_calls_total", command="xfs_quota report") == reports + 1
+    assert sample("managed_projects") == 1
+    assert sample("dirty_projects") == 1
+
+
 def test_quota_clear(quota_manager):
     """Test that quota clears between invocations"""
     homedirs = {"alpha": 1001, "beta": 1002, "gamma": 1003}
@@ -634,3 +1225,495 @@ def test_project_clear(quota_manager):
     for name, projid in homedirs.items():
         path = os.path.join(MOUNT_POINT, name)
         assert applied_projects[path] == projid + 1000
+
+
+def test_directory_watcher():
+    """Test that the inotify watcher reports top-level directories being added and removed"""
+    create_home_directories(MOUNT_POINT, {"existing": 1001})
+
+    with DirectoryWatcher([MOUNT_POINT]) as watcher:
+        # Nothing has happened yet
+        assert watcher.wait(0) == (set(), set(), False)
+
+        create_home_directories(MOUNT_POINT, {"new": 1002})
+        os.rmdir(os.path.join(MOUNT_POINT, "existing"))
+        # Files and nested directories are not homes, and should be ignored
+        with open(os.path.join(MOUNT_POINT, "new", "file.bin"), "w"):
+            pass
+        os.mkdir(os.path.join(MOUNT_POINT, "new", "nested"))
+
+        added, removed, rescan = watcher.wait(1)
+        assert added == {os.path.join(MOUNT_POINT, "new")}
+        assert removed == {os.path.join(MOUNT_POINT, "existing")}
+        assert not rescan
+
+        os.rmdir(os.path.join(MOUNT_POINT, "new", "nested"))
+
+
+def test_reconcile_changes(quota_manager):
+    """Test that added and removed home directories can be reconciled incrementally"""
+    create_home_directories(MOUNT_POINT, {"alpha": 1001, "beta": 1002})
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1  # 1GiB
+
+    quota_manager.reconcile_step()
+
+    # Add a home directory, and remove an existing one
+    create_home_directories(MOUNT_POINT, {"gamma": 1003})
+    os.rmdir(os.path.join(MOUNT_POINT, "alpha"))
+    quota_manager.reconcile_changes(
+        added=[os.path.join(MOUNT_POINT, "gamma")],
+        removed=[os.path.join(MOUNT_POINT, "alpha")],
+    )
+
+    assert quota_manager.parse_projids(quota_manager.projid_file) == {
+        os.path.join(MOUNT_POINT, "beta"): 1002,
+        os.path.join(MOUNT_POINT, "gamma"): 1003,
+    }
+
+    applied_projects = quota_manager.get_applied_projects()
+    assert applied_projects[os.path.join(MOUNT_POINT, "gamma")] == 1003
+
+    applied_quotas = quota_manager.get_applied_quotas()
+    assert applied_quotas[os.path.join(MOUNT_POINT, "gamma")]["blocks"] == {
+        "used": 0,
+        "soft": 0,
+        "hard": 1048576,
+    }
+
+    # Changing the intended quota of a single home directory only touches that one
+    quota_manager.quota_overrides = {"beta": 2}
+    quota_manager.reconcile_changes(changed=[os.path.join(MOUNT_POINT, "beta")])
+
+    applied_quotas = quota_manager.get_applied_quotas()
+    assert applied_quotas[os.path.join(MOUNT_POINT, "beta")]["blocks"]["hard"] == (
+        2 * GIB_TO_KIB
+    )
+
+
+def test_batched_limits(quota_manager):
+    """Test that limits are set correctly when split across several xfs_quota calls"""
+    homedirs = {f"user{i}": 1001 + i for i in range(5)}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1  # 1GiB
+    quota_manager.quota_overrides = {"user3": 2}
+    quota_manager.limit_batch_size = 2
+
+    quota_manager.reconcile_step()
+
+    applied_quotas = quota_manager.get_applied_quotas()
+    for name in homedirs:
+        expected_quota = 2 * GIB_TO_KIB if name == "user3" else GIB_TO_KIB
+        path = os.path.join(MOUNT_POINT, name)
+        assert applied_quotas[path]["blocks"]["hard"] == expected_quota
+
+
+def test_parallel_setups(fake_quota_manager, monkeypatch):
+    """Test that project setups overlap, but no more than max_parallel_setups at once"""
+    quota_manager = fake_quota_manager
+    create_home_directories(quota_manager.paths[0], [f"user{i}" for i in range(6)])
+    quota_manager.max_parallel_setups = 2
+    backend = quota_manager.quota_backend
+    backend.setup_latency = 0.3
+
+    running = set()
+    concurrency = []
+    lock = threading.Lock()
+    setup_project = backend.setup_project
+
+    def tracked_setup_project(mountpoint, project):
+        with lock:
+            running.add(project)
+            concurrency.append(len(running))
+        try:
+            setup_project(mountpoint, project)
+        finally:
+            with lock:
+                running.remove(project)
+
+    monkeypatch.setattr(backend, "setup_project", tracked_setup_project)
+    start = time.monotonic()
+    quota_manager.reconcile_step()
+    elapsed = time.monotonic() - start
+
+    assert len(concurrency) == 6
+    assert max(concurrency) == 2
+    # Three rounds of two setups, instead of six setups one after another
+    assert elapsed < 6 * backend.setup_latency
+    assert len(quota_manager.get_applied_projects()) == 6
+
+
+def test_mountpoint_for(quota_manager):
+    """Test that mount points are resolved without df, and cached per parent directory"""
+    create_home_directories(MOUNT_POINT, {"a": 1001, "b": 1002})
+
+    assert quota_manager.mountpoint_for(os.path.join(MOUNT_POINT, "a")) == MOUNT_POINT
+    assert quota_manager.mountpoint_for(os.path.join(MOUNT_POINT, "b")) == MOUNT_POINT
+    assert list(quota_manager._mountpoints) == [MOUNT_POINT]
+
+
+def test_setup_priority(quota_manager):
+    """Test that new and cheap project setups are scheduled before expensive ones"""
+
+    projects = {"new": 1001, "small": 1002, "huge": 1003, "protected": 1004}
+    quota_manager._applied_quotas = QuotaTable()
+    quota_manager._applied_quotas.set("small", QuotaRecord(inodes_used=10))
+    quota_manager._applied_quotas.set("huge", QuotaRecord(inodes_used=1_000_000))
+    quota_manager._applied_quotas.set("protected", QuotaRecord(inodes_used=1))
+    # Only "protected" is already tagged with its correct project ID
+    quota_manager._applied_projects = {"small": 2002, "huge": 2003, "protected": 1004}
+
+    assert sorted(
+        projects,
+        key=lambda project: quota_manager.setup_priority(project, projects[project]),
+    ) == ["new", "small", "huge", "protected"]
+
+
+def test_verify_changed_projects_only(quota_manager, monkeypatch):
+    """Test that project metadata is only re-read for directories that changed"""
+    homedirs = {"alpha": 1001, "beta": 1002}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.verify_changed_projects_only = True
+    quota_manager.reconcile_step()
+
+    expected_projects = {os.path.join(MOUNT_POINT, k): v for k, v in homedirs.items()}
+    assert quota_manager.get_applied_projects() == expected_projects
+
+    checked = []
+    read_project = quota_manager.quota_backend.read_project
+    monkeypatch.setattr(
+        quota_manager.quota_backend,
+        "read_project",
+        lambda path: checked.append(path) or read_project(path),
+    )
+
+    # Nothing changed, so nothing is read again
+    assert quota_manager.get_applied_projects() == expected_projects
+    assert checked == []
+
+    # Changing the mode bumps the inode change time
+    os.chmod(os.path.join(MOUNT_POINT, "beta"), 0o700)
+    assert quota_manager.get_applied_projects() == expected_projects
+    assert checked == [os.path.join(MOUNT_POINT, "beta")]
+
+
+def test_quotactl_backend(quota_manager):
+    """Test that the quotactl backend applies and reports the same quotas as xfs_quota"""
+    homedirs = {"alpha": 1001, "beta": 1002}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1  # 1GiB
+    quota_manager.quota_overrides = {"beta": 2}
+    quota_manager.quota_backend_class = QuotactlBackend
+
+    quota_manager.reconcile_step()
+
+    # Make sure we didn't silently fall back to xfs_quota
+    assert quota_manager.quota_backend.device_for(MOUNT_POINT) is not None
+
+    projects = quota_manager.parse_projids(quota_manager.projid_file)
+    quotactl_quotas = quota_manager.get_applied_quotas()
+    xfs_quota_quotas = XfsQuotaBackend(
+        projects_file=quota_manager.projects_file,
+        projid_file=quota_manager.projid_file,
+    ).get_applied_quotas([MOUNT_POINT], projects)
+
+    for name in homedirs:
+        path = os.path.join(MOUNT_POINT, name)
+        assert quotactl_quotas[path] == xfs_quota_quotas[path]
+    assert quotactl_quotas[os.path.join(MOUNT_POINT, "beta")]["blocks"]["hard"] == (
+        2 * GIB_TO_KIB
+    )
+
+
+def test_fake_backend(fake_quota_manager):
+    """Test reconciling with the in-memory backend, on a filesystem without quotas"""
+    quota_manager = fake_quota_manager
+    base = quota_manager.paths[0]
+    create_home_directories(base, ["alpha", "beta", "gamma"])
+    alpha, beta, gamma = (
+        os.path.join(base, name) for name in ["alpha", "beta", "gamma"]
+    )
+
+    quota_manager.hard_quota = 1
+    quota_manager.quota_overrides = {"beta": 2}
+    quota_manager.quota_backend.fail_projects = {gamma}
+    quota_manager.reconcile_step()
+
+    projects = quota_manager.parse_projids(quota_manager.projid_file)
+    assert quota_manager.get_applied_projects() == {
+        alpha: projects[alpha],
+        beta: projects[beta],
+    }
+    quotas = quota_manager.get_applied_quotas()
+    assert quotas[alpha]["blocks"]["hard"] == GIB_TO_KIB
+    assert quotas[beta]["blocks"]["hard"] == 2 * GIB_TO_KIB
+    assert gamma not in quotas
+
+    # Failed projects are retried on the next run
+    quota_manager.quota_backend.fail_projects = set()
+    quota_manager.reconcile_step()
+    assert gamma in quota_manager.get_applied_projects()
+    assert quota_manager.get_applied_quotas()[gamma]["blocks"]["hard"] == GIB_TO_KIB
+
+
+def test_incomplete_setups(fake_quota_manager, tmp_path, monkeypatch):
+    """Test that setups which stop partway are retried, though their top is tagged"""
+    quota_manager = fake_quota_manager
+    base = quota_manager.paths[0]
+    create_home_directories(base, ["alpha", "beta"])
+    alpha = os.path.join(base, "alpha")
+    quota_manager.state_file = os.fspath(tmp_path / "state.json")
+    backend = quota_manager.quota_backend
+    backend.tag_failed_setups = True
+    backend.fail_projects = {alpha}
+    quota_manager.reconcile_step()
+
+    # The top directory of alpha looks set up, but the setup didn't complete
+    assert alpha in quota_manager.get_applied_projects()
+    with open(quota_manager.state_file) as f:
+        assert json.load(f)["incomplete_setups"] == [alpha]
+
+    # So it is set up again, also after a restart
+    QuotaManager.clear_instance()
+    restarted = QuotaManager.instance(
+        paths=quota_manager.paths,
+        projid_file=quota_manager.projid_file,
+        projects_file=quota_manager.projects_file,
+        state_file=quota_manager.state_file,
+        quota_backend=backend,
+    )
+    assert restarted.load_state()
+    backend.fail_projects = set()
+    setups = record_setups(monkeypatch, backend)
+    restarted.reconcile_step()
+    assert setups == [alpha]
+    restarted.reconcile_step()
+    assert setups == [alpha]
+
+    # With asyncio, setups still running when the time budget runs out carry on
+    # instead of being killed
+    create_home_directories(base, ["gamma"])
+    gamma = os.path.join(base, "gamma")
+    restarted.use_asyncio = True
+    restarted.setup_time_budget = 0.1
+    backend.setup_latency = 0.5
+    start = time.monotonic()
+    restarted.reconcile_step()
+    assert time.monotonic() - start < backend.setup_latency
+    assert restarted._running_setups[gamma].result(timeout=5)
+    assert gamma in restarted.get_applied_projects()
+    assert not restarted._incomplete_setups
+
+
+def test_force_dirty_setup(fake_quota_manager, monkeypatch):
+    """Test that forcing quotas dirty sets up projects that are tagged already"""
+    quota_manager = fake_quota_manager
+    base = quota_manager.paths[0]
+    create_home_directories(base, ["alpha", "beta"])
+    quota_manager.reconcile_step()
+
+    setups = record_setups(monkeypatch, quota_manager.quota_backend)
+    quota_manager.reconcile_step()
+    assert setups == []
+
+    quota_manager.reconcile_step(quotas_is_dirty=True)
+    assert sorted(setups) == [os.path.join(base, "alpha"), os.path.join(base, "beta")]
+
+
+def test_setup_backlog(fake_quota_manager):
+    """Test that the setup backlog drains once deferred setups are done"""
+    quota_manager = fake_quota_manager
+    create_home_directories(quota_manager.paths[0], ["alpha", "beta", "gamma"])
+    quota_manager.quota_backend.setup_latency = 0.2
+    quota_manager.max_parallel_setups = 1
+    quota_manager.setup_time_budget = 0.1
+
+    def setup_backlog():
+        return REGISTRY.get_sample_value("jupyterhub_home_nfs_setup_backlog")
+
+    # One setup is left running, and the other two are deferred
+    quota_manager.reconcile_step()
+    assert setup_backlog() == 3
+
+    for _ in range(10):
+        for future in list(quota_manager._running_setups.values()):
+            future.result(timeout=5)
+        if len(quota_manager.get_applied_projects()) == 3:
+            break
+        quota_manager.reconcile_step()
+    # Nothing needs setting up any more, and the last setup finished in the background
+    quota_manager.reconcile_step()
+    assert REGISTRY.get_sample_value("jupyterhub_home_nfs_dirty_projects") == 0
+    assert setup_backlog() == 0
+
+
+def test_asyncio(quota_manager):
+    """Test that reconciling with asyncio subprocesses applies the same quotas"""
+    create_home_directories(MOUNT_POINT, ["alpha", "beta"])
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.hard_quota = 1
+    quota_manager.quota_overrides = {"beta": 2}
+    quota_manager.use_asyncio = True
+    quota_manager.reconcile_step()
+
+    alpha, beta = (os.path.join(MOUNT_POINT, name) for name in ["alpha", "beta"])
+    projects = quota_manager.parse_projids(quota_manager.projid_file)
+    assert quota_manager.get_applied_projects() == {
+        alpha: projects[alpha],
+        beta: projects[beta],
+    }
+    quotas = quota_manager.get_applied_quotas()
+    assert quotas[alpha]["blocks"]["hard"] == GIB_TO_KIB
+    assert quotas[beta]["blocks"]["hard"] == 2 * GIB_TO_KIB
+
+
+def test_command_timeout():
+    """Test that commands running for too long are killed"""
+    log = QuotaManager.instance().log
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        logged_check_call(["sleep", "10"], log, timeout=0.1)
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(async_logged_check_call(["sleep", "10"], log, timeout=0.1))
+    assert time.monotonic() - start < 5
+
+
+def test_iter_check_call():
+    """Test that output is streamed line by line, and logged stderr is capped"""
+    logger = logging.getLogger("test_iter_check_call")
+    logged = []
+    logger.addHandler(logging.Handler())
+    logger.handlers[-1].emit = lambda record: logged.append(record.getMessage())
+    logger.setLevel(logging.DEBUG)
+
+    script = "for i in $(seq 1 1000); do echo err$i >&2; echo out$i; done; exit 3"
+    lines = []
+    with pytest.raises(subprocess.CalledProcessError):
+        for line in iter_check_call(["sh", "-c", script], logger):
+            lines.append(line)
+    assert lines == [f"out{i}\n" for i in range(1, 1001)]
+
+    assert logged[0] == "(900 earlier lines of stderr not logged)"
+    assert logged[1:] == [f"err{i}" for i in range(901, 1001)]
+
+
+def test_setup_throttling(fake_quota_manager, tmp_path):
+    """Test that project setups are niced, paced and timed"""
+    backend = FakeQuotaBackend(setup_nice=10, setup_ionice_class="idle")
+    assert backend.setup_command_prefix() == [
+        "ionice",
+        "-c",
+        "idle",
+        "nice",
+        "-n",
+        "10",
+    ]
+    backend.setup_ionice_class = "best-effort"
+    assert backend.setup_command_prefix()[:5] == [
+        "ionice",
+        "-c",
+        "best-effort",
+        "-n",
+        "7",
+    ]
+
+    quota_manager = fake_quota_manager
+    quota_manager.setup_files_per_second = 1000
+    alpha, beta = (os.fspath(tmp_path / name) for name in ["alpha", "beta"])
+    quota_manager._applied_quotas.set(alpha, QuotaRecord(inodes_used=2000))
+    quota_manager._applied_quotas.set(beta, QuotaRecord(inodes_used=10))
+    # The first setup starts right away, and the next once alpha's 2000 files are
+    # walked at 1000 files per second
+    assert quota_manager.reserve_setup(alpha) == 0
+    assert 1.9 < quota_manager.reserve_setup(beta) <= 2
+
+    create_home_directories(quota_manager.paths[0], ["gamma"])
+    quota_manager.setup_files_per_second = 0
+    before = REGISTRY.get_sample_value(
+        "jupyterhub_home_nfs_project_setup_duration_seconds_count",
+        {"result": "success"},
+    )
+    quota_manager.reconcile_step()
+    after = REGISTRY.get_sample_value(
+        "jupyterhub_home_nfs_project_setup_duration_seconds_count",
+        {"result": "success"},
+    )
+    assert after == (before or 0) + 1
+
+
+def test_quota_table():
+    """Test that the quota table behaves like the nested dicts it replaces"""
+    table = QuotaTable()
+    for i, name in enumerate(["a", "b", "c"]):
+        table.set(name, QuotaRecord(blocks_used=i, blocks_hard=1000 + i))
+    table.set("b", QuotaRecord(blocks_used=5, inodes_used=7))
+
+    assert table.record("b") == QuotaRecord(blocks_used=5, inodes_used=7)
+    assert table["a"] == {
+        "blocks": {"used": 0, "soft": 0, "hard": 1000},
+        "inodes": {"used": 0, "soft": 0, "hard": 0},
+        "realtime": {"used": 0, "soft": 0, "hard": 0},
+    }
+
+    # Removing a row moves the last one into its place
+    table.discard("a")
+    table.discard("missing")
+    assert len(table) == 2
+    assert "a" not in table
+    assert table.record("a") is None
+    assert dict(table.records()) == {
+        "b": QuotaRecord(blocks_used=5, inodes_used=7),
+        "c": QuotaRecord(blocks_used=2, blocks_hard=1002),
+    }
+    with pytest.raises(KeyError):
+        table["a"]
+
+
+def test_state_file(quota_manager, tmp_path, monkeypatch):
+    """Test that project IDs and setups survive a restart that loses the projid file"""
+    homedirs = {"alpha": 1001, "beta": 1002, "gamma": 1003}
+    create_home_directories(MOUNT_POINT, homedirs)
+
+    quota_manager.paths = [MOUNT_POINT]
+    quota_manager.state_file = os.fspath(tmp_path / "state.json")
+    quota_manager.reconcile_step()
+    projects = quota_manager.parse_projids(quota_manager.projid_file)
+
+    # While we are down, the projid files are lost, 'beta' is removed and 'gamma'
+    # replaced by a new directory
+    os.remove(quota_manager.projid_file)
+    os.remove(quota_manager.projects_file)
+    os.rmdir(os.path.join(MOUNT_POINT, "beta"))
+    os.rename(os.path.join(MOUNT_POINT, "gamma"), os.path.join(MOUNT_POINT, ".old"))
+    create_home_directories(MOUNT_POINT, ["gamma"])
+    os.rmdir(os.path.join(MOUNT_POINT, ".old"))
+
+    QuotaManager.clear_instance()
+    restarted = QuotaManager.instance(
+        paths=[MOUNT_POINT],
+        projid_file=quota_manager.projid_file,
+        projects_file=quota_manager.projects_file,
+        state_file=quota_manager.state_file,
+        min_projid=1000,
+        hard_quota=quota_manager.hard_quota,
+    )
+    assert restarted.load_state()
+    alpha = os.path.join(MOUNT_POINT, "alpha")
+    assert restarted.parse_projids(restarted.projid_file) == {alpha: projects[alpha]}
+
+    setups = []
+    monkeypatch.setattr(
+        restarted.quota_backend,
+        "setup_project",
+        lambda mountpoint, project: setups.append(project),
+    )
+    restarted.reconcile_step()
+    # Only the replaced directory needs setting up again
+    assert setups == [os.path.join(MOUNT_POINT, "gamma")]